@@ -5,6 +5,7 @@ from torch import nn
 from transformers import BertPreTrainedModel
 from transformers.models.bert.modeling_bert import BertEmbeddings, BertEncoder, BertPooler
 from ..SubNets.AlignNets import AlignSubNet
+from ..SubNets.pretrained import from_pretrained
 
 class MAG(nn.Module):
     
@@ -316,15 +317,13 @@ class MAG_BERT(nn.Module):
 
         super(MAG_BERT, self).__init__()
         
-        self.model = MAG_BertForSequenceClassification.from_pretrained(
+        self.model = from_pretrained(MAG_BertForSequenceClassification, 
             args.text_pretrained_model, args=args)
 
         args.feat_size = args.text_feat_dim
         
     def forward(self, text_feats, video_feats, audio_feats, *args, **kwargs):
         
-        video_feats, audio_feats = video_feats.float(), audio_feats.float()
-        
         logits, hidden_states = self.model(
             text=text_feats,
             visual=video_feats,
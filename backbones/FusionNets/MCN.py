@@ -70,8 +70,6 @@ class MCN(nn.Module):
     def forward(self, text, video, audio, mode='train'): 
         text = self.text_embedding(text)
         # what to do with audio? using mean? TODO
-        video = torch.tensor(video, dtype=torch.float)
-        audio = torch.tensor(audio, dtype=torch.float)
         if self.feature_extractor_method == 'mean':
             video = video.mean(dim=1)  # temporary use mean, actually view(-1,shape[-1]), choices: mean, Conv1d, LSTM, Transformer
             audio = audio.mean(dim=1)  # this averages features from 0 padding too  
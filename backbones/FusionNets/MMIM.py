@@ -271,8 +271,8 @@ class MMIM(nn.Module):
         text, audio, and vision should have dimension [batch_size, seq_len, n_features]
         For Bert input, the length of text is "seq_len + 2"
         """
-        video_feats = video_data['feats'].float()
-        audio_feats = audio_data['feats'].float()
+        video_feats = video_data['feats']
+        audio_feats = audio_data['feats']
         video_lengths = video_data['lengths'].int().detach().cpu()
         audio_lengths = audio_data['lengths'].int().detach().cpu()
 
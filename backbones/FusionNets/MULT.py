@@ -93,8 +93,8 @@ class MULT(nn.Module):
         text = self.text_subnet(text_feats)
 
         x_l = F.dropout(text.transpose(1, 2), p=self.text_dropout, training=self.training)
-        x_a = audio_feats.transpose(1, 2).float()
-        x_v = video_feats.transpose(1, 2).float()
+        x_a = audio_feats.transpose(1, 2)
+        x_v = video_feats.transpose(1, 2)
 
         proj_x_l = x_l if self.orig_d_l == self.d_l else self.proj_l(x_l)
         proj_x_a = x_a if self.orig_d_a == self.d_a else self.proj_a(x_a)
@@ -1,5 +1,6 @@
 import torch
 from ..SubNets.FeatureNets import BERTEncoderSDIF, BertCrossEncoder
+from ..SubNets.pretrained import from_pretrained
 from torch import nn
 from transformers import BertConfig
 
@@ -12,7 +13,7 @@ class SDIF(nn.Module):
 
         super(SDIF, self).__init__()
         self.args = args
-        self.text_subnet = BERTEncoderSDIF.from_pretrained(args.text_pretrained_model)
+        self.text_subnet = from_pretrained(BERTEncoderSDIF, args.text_pretrained_model)
         self.visual_size = args.video_feat_dim
         self.acoustic_size = args.audio_feat_dim
         self.text_size = args.text_feat_dim
@@ -8,6 +8,7 @@ from transformers.models.bert.modeling_bert import BertEmbeddings, BertEncoder,
 from transformers.modeling_outputs import BaseModelOutputWithPoolingAndCrossAttentions
 from ..SubNets.transformers_encoder.transformer import TransformerEncoder
 from ..SubNets.AlignNets import AlignSubNet
+from ..SubNets.pretrained import from_pretrained
 
 class MAG(nn.Module):
     def __init__(self,  config, args):
@@ -563,8 +564,8 @@ class TCL_MAP(nn.Module):
         
         super(TCL_MAP, self).__init__()
         
-        self.model = MAP_Model.from_pretrained(args.text_pretrained_model, args=args)
-        self.cons_model = Cons_Model.from_pretrained(args.text_pretrained_model, args=args)
+        self.model = from_pretrained(MAP_Model, args.text_pretrained_model, args=args)
+        self.cons_model = from_pretrained(Cons_Model, args.text_pretrained_model, args=args)
         
         self.ctx_vectors = self._init_ctx(args)
         self.ctx = nn.Parameter(self.ctx_vectors)
@@ -581,8 +582,6 @@ class TCL_MAP(nn.Module):
 
     
     def forward(self, text_feats, video_feats, audio_feats, cons_text_feats, condition_idx):
-        video_feats = video_feats.float()
-        audio_feats = audio_feats.float()
 
         # process normal sample
         outputs, pooled_output, condition, generated_ctx = self.model(
@@ -59,8 +59,8 @@ class UMC(nn.Module):
            
     def forward(self, text_feats, video_feats, audio_feats, mode = None): 
 
-        video = video_feats.float()
-        audio = audio_feats.float()
+        video = video_feats
+        audio = audio_feats
         text = self.text_embedding(text_feats) 
 
         video = self.video_layer(video)
@@ -79,6 +79,38 @@ class UMC(nn.Module):
             features = self.fusion_layer(torch.cat((text, audio, video), dim=1))
             return features
 
+    def encode_modality(self, feats, layer, encoder):
+
+        feats = layer(feats)
+        feats = feats.permute(1, 0, 2)
+
+        return encoder(feats)[-1]
+
+    def forward_views(self, text_feats, video_feats, audio_feats):
+        '''
+        The features of the three views of UMC: video zeroed, audio zeroed, and full.
+        The text and each modality are encoded once. The zeroed modalities are the same for all the samples,
+        so they are encoded from a single zero sequence and broadcast to the batch.
+        '''
+        text = self.text_embedding(text_feats)
+        text = self.text_layer(text[:, 0])
+
+        video = self.encode_modality(video_feats, self.video_layer, self.v_encoder)
+        audio = self.encode_modality(audio_feats, self.audio_layer, self.a_encoder)
+
+        zero_video = self.encode_modality(torch.zeros_like(video_feats[:1]), self.video_layer, self.v_encoder).expand_as(video)
+        zero_audio = self.encode_modality(torch.zeros_like(audio_feats[:1]), self.audio_layer, self.a_encoder).expand_as(audio)
+
+        # The fusion of the three views runs as one batch
+        fusion_inputs = torch.cat((
+            torch.cat((text, audio, zero_video), dim=1),
+            torch.cat((text, zero_audio, video), dim=1),
+            torch.cat((text, audio, video), dim=1),
+        ))
+        features = self.fusion_layer(fusion_inputs)
+
+        return features
+
 class UMCModel(nn.Module):
 
     def __init__(self, args):
@@ -108,4 +140,11 @@ class UMCModel(nn.Module):
             mlp_output = self.mlp_head(features)
 
             return features, mlp_output
+
+        elif mode == 'views':
+            # The features of the full view and the mlp outputs of the video-zeroed, audio-zeroed and full views
+            features = self.backbone.forward_views(text, video, audio)
+            mlp_output = self.mlp_head(features)
+
+            return torch.chunk(features, 3)[-1], torch.chunk(mlp_output, 3)
         
\ No newline at end of file
@@ -6,8 +6,9 @@ from torch.nn.utils.rnn import pack_padded_sequence
 from transformers.models.bert.modeling_bert import BertLayer
 import copy
 import math
+from .pretrained import from_pretrained
 
-__all__ = [ 'BERTEncoder', 'ROBERTAEncoder']
+__all__ = [ 'BERTEncoder', 'ROBERTAEncoder', 'cache_frozen_text_states']
 
 def freeze_backbone_parameters(model):
     for name, param in model.named_parameters():  
@@ -16,25 +17,165 @@ def freeze_backbone_parameters(model):
             param.requires_grad = True
     return model
 
+def get_num_frozen_layers(bert):
+    '''
+    The number of bottom layers (with the embeddings) of bert without any trainable parameter.
+    '''
+    if any(p.requires_grad for p in bert.embeddings.parameters()):
+        return 0
+
+    for i, layer in enumerate(bert.encoder.layer):
+        if any(p.requires_grad for p in layer.parameters()):
+            return i
+
+    return len(bert.encoder.layer)
+
+class FrozenTextCache:
+    '''
+    The hidden states of the frozen bottom layers of a text encoder, looked up by the content of the text features (token ids, masks and segment ids).
+    It is shared by the copies of the encoder (e.g., the best model kept by early stopping), and kept on the CPU.
+    '''
+    def __init__(self):
+        self.clear()
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def clear(self, num_layers = None):
+
+        self.num_layers = num_layers
+        self.index = {}
+        self.chunks = []
+        self.states = None
+
+    def get_keys(self, text_feats):
+
+        return [row.tobytes() for row in text_feats.cpu().long().numpy()]
+
+    def add(self, keys, states):
+
+        st = len(self.index)
+        for i, key in enumerate(keys):
+            self.index[key] = st + i
+
+        self.chunks.append(states)
+
+    def lookup(self, text_feats):
+        '''
+        The cached states of all the rows of text_feats, or None if any of them is not cached (e.g., augmented texts).
+        '''
+        if len(self.index) == 0:
+            return None
+
+        rows = [self.index.get(key) for key in self.get_keys(text_feats)]
+        if any(row is None for row in rows):
+            return None
+
+        if len(self.chunks) > 0:
+            self.states = torch.cat(([self.states] if self.states is not None else []) + self.chunks)
+            self.chunks = []
+
+        return self.states[torch.tensor(rows)]
+
 class BERTEncoder(nn.Module):
 
     def __init__(self, args):
 
         super(BERTEncoder, self).__init__()
-        self.bert = BertModel.from_pretrained(args.text_pretrained_model)
+        self.bert = from_pretrained(BertModel, args.text_pretrained_model)
         if args.freeze_backbone_parameters:
             self.bert = freeze_backbone_parameters(self.bert)
+
+        # The states of the frozen layers are computed once for the cached texts, and only the trainable top layers run on them
+        self.frozen_cache = FrozenTextCache() if args.get('frozen_text_cache', False) else None
+        if self.frozen_cache is not None:
+            self._register_load_state_dict_pre_hook(self._check_frozen_cache)
     
     def forward(self, text_feats = None, embeds = None, sent_mask = None, mixup = False):
         
         if mixup:
             outputs = self.bert(inputs_embeds=embeds, attention_mask = sent_mask)
         else:
+            last_hidden_states = self._cached_forward(text_feats) if self.frozen_cache is not None else None
+            if last_hidden_states is not None:
+                return last_hidden_states
+
             outputs = self.bert(text_feats[:, 0], text_feats[:, 1], text_feats[:, 2])
 
         last_hidden_states = outputs.last_hidden_state
         return last_hidden_states
 
+    @torch.no_grad()
+    def cache_frozen_states(self, text_feats):
+        '''
+        Computes (without dropout) and caches the states of the frozen layers for the texts that are not cached yet.
+        '''
+        num_frozen = get_num_frozen_layers(self.bert)
+        if num_frozen == 0:
+            return
+        if num_frozen != self.frozen_cache.num_layers:
+            self.frozen_cache.clear(num_frozen)
+
+        keys = self.frozen_cache.get_keys(text_feats)
+        new_keys = {}
+        for i, key in enumerate(keys):
+            if key not in self.frozen_cache.index and key not in new_keys:
+                new_keys[key] = i
+
+        if len(new_keys) == 0:
+            return
+
+        text_feats = text_feats[list(new_keys.values())].to(next(self.bert.parameters()).device)
+
+        training = self.bert.training
+        self.bert.eval()
+        outputs = self.bert(text_feats[:, 0], text_feats[:, 1], text_feats[:, 2], output_hidden_states = True)
+        self.bert.train(training)
+
+        self.frozen_cache.add(list(new_keys.keys()), outputs.hidden_states[num_frozen].cpu())
+
+    def _cached_forward(self, text_feats):
+
+        if self.frozen_cache.num_layers is None or get_num_frozen_layers(self.bert) != self.frozen_cache.num_layers:
+            return None
+
+        hidden_states = self.frozen_cache.lookup(text_feats)
+        if hidden_states is None:
+            return None
+
+        hidden_states = hidden_states.to(text_feats.device)
+        # The additive attention mask of BertModel.get_extended_attention_mask
+        attention_mask = (1.0 - text_feats[:, 1][:, None, None, :].to(hidden_states.dtype)) * torch.finfo(hidden_states.dtype).min
+
+        for layer in self.bert.encoder.layer[self.frozen_cache.num_layers:]:
+            hidden_states = layer(hidden_states, attention_mask = attention_mask)
+            hidden_states = hidden_states[0] if isinstance(hidden_states, tuple) else hidden_states
+
+        return hidden_states
+
+    def _check_frozen_cache(self, state_dict, prefix, *args):
+        # The cached states are dropped if new weights of the frozen layers are loaded
+        for name, param in self.bert.named_parameters():
+            key = prefix + 'bert.' + name
+            if not param.requires_grad and key in state_dict and not torch.equal(state_dict[key].to(param.device), param):
+                self.frozen_cache.clear()
+                return
+
+def cache_frozen_text_states(model, dataloaders):
+    '''
+    Fills the frozen-layer caches of the text encoders in model (with --frozen_text_cache) with the texts of the dataloaders.
+    '''
+    encoders = [m for m in model.modules() if isinstance(m, BERTEncoder) and m.frozen_cache is not None]
+    if len(encoders) == 0:
+        return
+
+    for dataloader in dataloaders:
+        for batch in dataloader:
+            if batch['text_feats'].dim() != 3:
+                continue
+            for encoder in encoders:
+                encoder.cache_frozen_states(batch['text_feats'])
+
 class BERTEncoderSDIF(BertPreTrainedModel):
 
     def __init__(self, config):
@@ -55,7 +196,7 @@ class RoBERTaEncoder(nn.Module):
     def __init__(self, args):
 
         super(RoBERTaEncoder, self).__init__()
-        self.roberta = RobertaModel.from_pretrained(args.text_pretrained_model)
+        self.roberta = from_pretrained(RobertaModel, args.text_pretrained_model)
         if args.freeze_backbone_parameters:
             self.roberta = freeze_backbone_parameters(self.roberta)
 
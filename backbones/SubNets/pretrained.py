@@ -0,0 +1,54 @@
+import os
+import copy
+from transformers.modeling_utils import load_state_dict
+from transformers.utils import WEIGHTS_NAME, SAFE_WEIGHTS_NAME
+
+__all__ = ['from_pretrained', 'load_pretrained_weights']
+
+# The pretrained weights and configs read by this process, keyed by their files
+_state_dicts = {}
+_configs = {}
+
+def get_weights_file(pretrained_model_path):
+    '''
+    The single weights file of a local pretrained model (None for model names and sharded weights).
+    '''
+    if not os.path.isdir(pretrained_model_path):
+        return None
+
+    for weights_name in [SAFE_WEIGHTS_NAME, WEIGHTS_NAME]:
+        weights_file = os.path.join(pretrained_model_path, weights_name)
+        if os.path.isfile(weights_file):
+            return weights_file
+
+    return None
+
+def load_pretrained_weights(pretrained_model_path):
+    '''
+    Reads the pretrained weights into the cache of this process (e.g., before forking the jobs, which then share them).
+    '''
+    weights_file = get_weights_file(pretrained_model_path)
+    if weights_file is None:
+        return None
+
+    if weights_file not in _state_dicts:
+        _state_dicts[weights_file] = load_state_dict(weights_file)
+
+    return _state_dicts[weights_file]
+
+def from_pretrained(model_class, pretrained_model_path, **kwargs):
+    '''
+    The same model as model_class.from_pretrained(pretrained_model_path, **kwargs), but the pretrained weights are read from disk
+    only once per process. Each new model is built from a copy of the cached weights, so training never changes them.
+    '''
+    state_dict = load_pretrained_weights(pretrained_model_path)
+    if state_dict is None:
+        return model_class.from_pretrained(pretrained_model_path, **kwargs)
+
+    config_key = (pretrained_model_path, model_class.config_class)
+    if config_key not in _configs:
+        _configs[config_key] = model_class.config_class.from_pretrained(pretrained_model_path)
+
+    state_dict = {k: v.clone() for k, v in state_dict.items()}
+
+    return model_class.from_pretrained(None, config = copy.deepcopy(_configs[config_key]), state_dict = state_dict, **kwargs)
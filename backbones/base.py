@@ -41,6 +41,15 @@ class MIA(nn.Module):
         mm_model = self.model(text_feats, video_data, audio_data, *args, **kwargs)
 
         return mm_model
+
+    def forward_views(self, num_views, text_feats, video_data, audio_data, *args, **kwargs):
+        '''
+        The outputs of num_views stochastic views (i.e., different dropout masks) of the same batch, computed in one forward of the stacked views.
+        '''
+        inputs = [torch.cat([x] * num_views) for x in [text_feats, video_data, audio_data]]
+        outputs = self.model(*inputs, *args, **kwargs)
+
+        return torch.chunk(outputs, num_views)
     
     def vim(self):
 
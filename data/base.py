@@ -7,8 +7,8 @@ import copy
 
 from .mm_pre import MMDataset,AuGDataset
 from .text_pre import get_t_data
-from .utils import get_v_a_data
-from .text_pre import TextDataset
+from .utils import get_v_a_data, get_data_fingerprint, get_data_cache_file, load_data_cache, save_data_cache
+from .text_pre import TextDataset, DatasetProcessor
 from .__init__ import benchmarks
 from .text_pre import get_ood_text_dataset
 from .mm_pre import get_ood_mm_dataset
@@ -48,48 +48,123 @@ class DataManager:
                 speaker_map[speaker_name] = i
 
             args.speaker_map = speaker_map
-        
-        if args.dialogue_mode == 'single_turn':
-            if args.clustering:
-                self.data, self.train_outputs = get_clu_data(args, bm, label_map, self.logger)
-            else:
-                self.data = prepare_data(args, self.logger, self.label_list, bm)
-
-        elif args.dialogue_mode == 'multi_turn':
-            self.data = prepare_multiturn_data(args, self.logger, self.label_list, bm)
 
-# Multi-turn dialogues
-def dialogue_merge(outputs, mode, data_args, elem):
+        # Identifies the prepared data, e.g., in the keys of the cached pretrained models
+        self.fingerprint = get_data_fingerprint(args, bm)
+        
+        # Shared memory holds the compact tensors of the single-turn datasets, the dialogues of multi-turn data cannot be compact
+        shared_data_path = args.shared_data_path
+        if shared_data_path is not None and args.dialogue_mode == 'multi_turn':
+            self.logger.warning('Multi-turn data cannot be shared in memory (--shared_data_path), they are prepared in each run.')
+            shared_data_path = None
+
+        if shared_data_path is not None:
+            args.compact_dataset = True
+            shared_prefix = os.path.join(shared_data_path, 'mia_' + get_data_fingerprint(args, bm))
+            shared_file = shared_prefix + '_data.pkl'
+
+            if os.path.exists(shared_file):
+                self.logger.info('Attaching to the prepared data in shared memory %s', shared_prefix)
+                cache = load_data_cache(shared_file)
+
+                self.data = cache['data']
+                self.train_outputs = get_shared_train_outputs(self.data['train']) if cache['train_outputs'] else None
+                args.update(cache['args'])
+                return
+
+        cache_file = None
+        if args.data_cache_path is not None:
+            cache_file = get_data_cache_file(args, bm)
+
+        if cache_file is not None and os.path.exists(cache_file):
+            self.logger.info('Loading prepared data from %s', cache_file)
+            cache = load_data_cache(cache_file)
+            
+            self.data, self.train_outputs = cache['data'], cache['train_outputs']
+            args.update(cache['args'])
 
-    temp = {}
-    temp_utt_id = {}
+        else:
+            self.train_outputs = None
+
+            if args.dialogue_mode == 'single_turn':
+                if args.clustering:
+                    self.data, self.train_outputs = get_clu_data(args, bm, label_map, self.logger)
+                else:
+                    self.data = prepare_data(args, self.logger, self.label_list, bm)
+
+            elif args.dialogue_mode == 'multi_turn':
+                self.data = prepare_multiturn_data(args, self.logger, self.label_list, bm)
+
+            if cache_file is not None:
+
+                cache = {
+                    'data': self.data,
+                    'train_outputs': self.train_outputs,
+                    'args': {k: args[k] for k in ['num_train_examples', 'max_cons_seq_length'] if k in args}
+                }
+                save_data_cache(cache_file, cache)
+                self.logger.info('Prepared data are cached in %s', cache_file)
+
+        if shared_data_path is not None:
+
+            for key in self.data.keys():
+                if getattr(self.data[key], 'compact', False):
+                    self.data[key].share_memory(shared_prefix + '_' + key)
+
+            # The train outputs of clustering hold the same features as the train dataset, they are rebuilt from its shared tensors
+            if self.train_outputs is not None:
+                self.train_outputs = get_shared_train_outputs(self.data['train'])
+
+            # The shared datasets are pickled as references to the shared tensors
+            cache = {
+                'data': self.data,
+                'train_outputs': self.train_outputs is not None,
+                'args': {k: args[k] for k in ['num_train_examples', 'max_cons_seq_length'] if k in args}
+            }
+            save_data_cache(shared_file, cache)
+            self.logger.info('Prepared data are shared in %s', shared_prefix)
+
+def get_shared_train_outputs(train_data):
+    '''
+    The train outputs of the clustering methods (text, video, audio and label_ids) as views of the tensors of the compact train dataset, 
+    so that the runs attached to shared memory do not hold their own copies of the features.
+    Ragged video and audio features are cut to their lengths.
+    '''
+    train_outputs = {
+        'text': train_data.text_data,
+        'label_ids': train_data.label_ids.tolist(),
+    }
 
-    for i, (key, v) in enumerate(zip(data_args[mode + '_data_index'], elem)):
+    for modality in ['video', 'audio']:
+        data = getattr(train_data, modality + '_data')
+        feats, lengths = data['feats'], data['lengths']
 
-        dia_id = key.split('_')[0][3:]
-        utt_id = int(key.split('_')[1][3:])
+        if train_data.ragged[modality]:
+            feats = [x[:l] for x, l in zip(feats, lengths.tolist())]
 
-        if dia_id not in temp.keys():
-            temp[dia_id] = []
-            temp_utt_id[dia_id] = {}
+        train_outputs[modality] = {'feats': feats, 'lengths': lengths.tolist()}
 
-        if utt_id not in temp_utt_id[dia_id].keys():
-            temp_utt_id[dia_id][utt_id] = []
+    return train_outputs
 
-        temp_utt_id[dia_id][utt_id].append(v)
+# Multi-turn dialogues
+def get_dialogue_groups(data_index):
+    '''
+    Groups the utterances by dialogue in one pass over the keys (e.g., 'dia12_utt3'). 
+    Returns the positions of the utterances of each dialogue sorted by the utterance ids, with the dialogues in the order of their first appearance.
+    Only the first one of duplicated utterances is kept.
+    '''
+    groups = {}
+
+    for i, key in enumerate(data_index):
+        
+        dia_key, utt_key = key.split('_')[:2]
+        groups.setdefault(dia_key[3:], {}).setdefault(int(utt_key[3:]), i)
 
-    for k in temp_utt_id.keys():
-        sorted_temp = []
-        for j in sorted (temp_utt_id[k]) : 
-            sorted_temp.append(temp_utt_id[k][j][0])
-            
-        temp[k] = sorted_temp
-    
-    keys = list(temp.keys())
+    return [[utts[utt_id] for utt_id in sorted(utts)] for utts in groups.values()]
 
-    new_keys = {keys[i]: i for i in range(len(keys))}
+def dialogue_merge(groups, elem):
 
-    return new_keys, temp
+    return {i: [elem[pos] for pos in group] for i, group in enumerate(groups)}
 
 def singleturn2multiturn(args, outputs, data_args):
 
@@ -106,43 +181,25 @@ def singleturn2multiturn(args, outputs, data_args):
         if key.endswith('label_ids'):
             label_ids_list.append(key)
 
+    # The grouping index of each split is shared by all modalities, lengths, speakers and labels
+    groups = {mode: get_dialogue_groups(data_args[mode + '_data_index']) for mode in ['train', 'dev', 'test']}
+
     for mode in ['train', 'dev', 'test'] :
 
         for modality in modality_list: 
         
             if modality == 'text_data':
-
-                feats = outputs[modality][mode]
-                keys, infos = dialogue_merge(outputs, mode, data_args, feats)
-                results = {keys[k]: v for k, v in infos.items()}
-                outputs[modality][mode] = results
+                outputs[modality][mode] = dialogue_merge(groups[mode], outputs[modality][mode])
 
             else:
-                feats = outputs[modality][mode]['feats']
-                keys, infos = dialogue_merge(outputs, mode, data_args, feats)
-                results = {keys[k]: v for k, v in infos.items()}
-                outputs[modality][mode]['feats'] = results
-
-                lengths = outputs[modality][mode]['lengths']
-                keys, infos = dialogue_merge(outputs, mode, data_args, lengths)
-                results = {keys[k]: v for k, v in infos.items()}
-                outputs[modality][mode]['lengths'] = results
+                outputs[modality][mode]['feats'] = dialogue_merge(groups[mode], outputs[modality][mode]['feats'])
+                outputs[modality][mode]['lengths'] = dialogue_merge(groups[mode], outputs[modality][mode]['lengths'])
 
     for speaker_ids_name in speaker_ids_list:
-
-        speaker_ids = outputs[speaker_ids_name]
-        keys, infos = dialogue_merge(outputs, speaker_ids_name.split('_')[0], data_args, speaker_ids)
-        results = {keys[k]: v for k, v in infos.items()}
-
-        outputs[speaker_ids_name] = results
+        outputs[speaker_ids_name] = dialogue_merge(groups[speaker_ids_name.split('_')[0]], outputs[speaker_ids_name])
 
     for label_ids_name in label_ids_list:
-
-        label_ids = outputs[label_ids_name]
-        keys, infos = dialogue_merge(outputs, label_ids_name.split('_')[0], data_args, label_ids)
-        results = {keys[k]: v for k, v in infos.items()}      
-
-        outputs[label_ids_name] = results
+        outputs[label_ids_name] = dialogue_merge(groups[label_ids_name.split('_')[0]], outputs[label_ids_name])
 
     return outputs
 
@@ -231,9 +288,9 @@ def prepare_data(args, logger, label_list, bm):
 
         text_data = ind_outputs['text_data']
 
-        text_train_data = TextDataset(train_label_ids, text_data['train'])
-        text_dev_data = TextDataset(dev_label_ids, text_data['dev'])
-        text_test_data = TextDataset(test_label_ids, text_data['test'])
+        text_train_data = TextDataset(train_label_ids, text_data['train'], compact = args.compact_dataset)
+        text_dev_data = TextDataset(dev_label_ids, text_data['dev'], compact = args.compact_dataset)
+        text_test_data = TextDataset(test_label_ids, text_data['test'], compact = args.compact_dataset)
         
         data = {'train': text_train_data, 'dev': text_dev_data, 'test': text_test_data}
 
@@ -242,13 +299,13 @@ def prepare_data(args, logger, label_list, bm):
         text_data, video_data, audio_data = ind_outputs['text_data'], ind_outputs['video_data'], ind_outputs['audio_data']
         ind_other_hyper = get_other_hyper(ind_outputs)
 
-        mm_train_data = MMDataset(train_label_ids, text_data['train'], video_data['train'], audio_data['train'], other_hyper = ind_other_hyper['train'])
-        mm_dev_data = MMDataset(dev_label_ids, text_data['dev'], video_data['dev'], audio_data['dev'], other_hyper = ind_other_hyper['dev'])
-        mm_test_data = MMDataset(test_label_ids, text_data['test'], video_data['test'], audio_data['test'], other_hyper = ind_other_hyper['test'])
+        mm_train_data = MMDataset(train_label_ids, text_data['train'], video_data['train'], audio_data['train'], other_hyper = ind_other_hyper['train'], compact = args.compact_dataset)
+        mm_dev_data = MMDataset(dev_label_ids, text_data['dev'], video_data['dev'], audio_data['dev'], other_hyper = ind_other_hyper['dev'], compact = args.compact_dataset)
+        mm_test_data = MMDataset(test_label_ids, text_data['test'], video_data['test'], audio_data['test'], other_hyper = ind_other_hyper['test'], compact = args.compact_dataset)
 
 
         if args.aug:
-            mm_aug_data = AuGDataset(aug_label_ids, text_data['aug'])
+            mm_aug_data = AuGDataset(aug_label_ids, text_data['aug'], compact = args.compact_dataset)
         
         data = {'train': mm_train_data, 'dev': mm_dev_data, 'test': mm_test_data}
         
@@ -298,10 +355,16 @@ def get_data(args, logger, data_path, bm, label_map):
         'train_data_index': train_outputs['indexes'],
         'dev_data_index': dev_outputs['indexes'],
         'test_data_index': test_outputs['indexes'],
-        'label_map': label_map
+        'label_map': label_map,
+        'annotations': {'train': train_outputs, 'dev': dev_outputs, 'test': test_outputs}
     }
     if args.method == 'sdif':
         data_args.update({'augment_data_index': augment_outputs['indexes']})
+        data_args['annotations']['aug'] = augment_outputs
+
+    # A test-only run reads the train and dev features only if they are used
+    if not args.train and args.dialogue_mode == 'single_turn':
+        data_args['lazy_modes'] = ['train', 'dev']
  
     if args.method in ['text', 'text_ood']:
 
@@ -321,10 +384,10 @@ def get_data(args, logger, data_path, bm, label_map):
         text_data = get_t_data(args, data_args)
 
         video_feats_path = os.path.join(data_args['data_path'], args.video_data_path, args.video_feats_path)
-        video_data = get_v_a_data(data_args, video_feats_path, args.video_seq_len)
+        video_data = get_v_a_data(data_args, video_feats_path, args.video_seq_len, args.dynamic_padding, args.feats_dtype)
 
         audio_feats_path = os.path.join(data_args['data_path'], args.audio_data_path, args.audio_feats_path)
-        audio_data = get_v_a_data(data_args, audio_feats_path, args.audio_seq_len)  
+        audio_data = get_v_a_data(data_args, audio_feats_path, args.audio_seq_len, args.dynamic_padding, args.feats_dtype)  
         
         outputs = {
             'video_data': video_data,
@@ -361,8 +424,11 @@ def get_ood_data(args, logger, data_path, bm, label_map):
     test_outputs = {}
     data_args = {
         'data_path': data_path,
-        'label_map': label_map
+        'label_map': label_map,
+        'annotations': {}
     }
+    if not args.train:
+        data_args['lazy_modes'] = ['train', 'dev']
 
     if args.train_ood:
         
@@ -370,11 +436,13 @@ def get_ood_data(args, logger, data_path, bm, label_map):
         dev_outputs = get_indexes_annotations(args, bm, label_map, os.path.join(data_path, 'dev.tsv'))
         args.num_train_examples += len(train_outputs['indexes'])
         data_args.update({'train_data_index': train_outputs['indexes'],'dev_data_index': dev_outputs['indexes']})
+        data_args['annotations'].update({'train': train_outputs, 'dev': dev_outputs})
     
     if args.test_ood:
         
         test_outputs = get_indexes_annotations(args, bm, label_map, os.path.join(data_path, 'test.tsv'))
         data_args.update({'data_path': data_path, 'test_data_index': test_outputs['indexes'], 'label_map': label_map})
+        data_args['annotations'].update({'test': test_outputs})
         
     
 
@@ -398,10 +466,10 @@ def get_ood_data(args, logger, data_path, bm, label_map):
         text_data = get_t_data(args, data_args)
 
         video_feats_path = os.path.join(data_args['data_path'], args.video_data_path, args.video_feats_path)
-        video_data = get_v_a_data(data_args, video_feats_path, args.video_seq_len)
+        video_data = get_v_a_data(data_args, video_feats_path, args.video_seq_len, args.dynamic_padding, args.feats_dtype)
 
         audio_feats_path = os.path.join(data_args['data_path'], args.audio_data_path, args.audio_feats_path)
-        audio_data = get_v_a_data(data_args, audio_feats_path, args.audio_seq_len)  
+        audio_data = get_v_a_data(data_args, audio_feats_path, args.audio_seq_len, args.dynamic_padding, args.feats_dtype)  
         
         outputs = {
             'video_data': video_data,
@@ -447,23 +515,27 @@ def get_clu_data(args, bm, label_map, logger):
         'data_path': data_path,
         'train_data_index': train_data_index,
         'test_data_index': test_data_index,
+        'annotations': {
+            'train': {key: train_outputs[key] + dev_outputs[key] for key in train_outputs.keys()},
+            'test': test_outputs
+        }
     }
         
     text_data = get_t_data(args, data_args)
         
     video_feats_path = os.path.join(data_args['data_path'], args.video_data_path, args.video_feats_path)
-    video_data = get_v_a_data(data_args, video_feats_path, args.video_seq_len)
+    video_data = get_v_a_data(data_args, video_feats_path, args.video_seq_len, args.dynamic_padding, args.feats_dtype)
     
     audio_feats_path = os.path.join(data_args['data_path'], args.audio_data_path, args.audio_feats_path)
-    audio_data = get_v_a_data(data_args, audio_feats_path, args.audio_seq_len)
+    audio_data = get_v_a_data(data_args, audio_feats_path, args.audio_seq_len, args.dynamic_padding, args.feats_dtype)
     
-    mm_train_data = MMDataset(train_label_ids, text_data['train'], video_data['train'], audio_data['train'])
-    mm_test_data = MMDataset(test_label_ids, text_data['test'], video_data['test'], audio_data['test'])
+    mm_train_data = MMDataset(train_label_ids, text_data['train'], video_data['train'], audio_data['train'], compact = args.compact_dataset)
+    mm_test_data = MMDataset(test_label_ids, text_data['test'], video_data['test'], audio_data['test'], compact = args.compact_dataset)
 
     mm_data = {'train': mm_train_data, 'test': mm_test_data}
     
     train_outputs = {
-        'text': text_data['train'],
+        'text': mm_train_data.text_data,
         'video': video_data['train'],
         'audio': audio_data['train'],
         'label_ids': train_label_ids,
@@ -472,46 +544,56 @@ def get_clu_data(args, bm, label_map, logger):
     return mm_data, train_outputs
 
 def get_indexes_annotations(args, bm, label_map, read_file_path):
-
-    with open(read_file_path, 'r') as f:
-
-        data = csv.reader(f, delimiter="\t")
-        indexes = []
-        label_ids = []
-        speaker_ids = []
-
-        for i, line in enumerate(data):
-            if i == 0:
-                continue
-
-            if args.dataset in ['MIntRec', 'MIntRec-OOD']:
-                index = '_'.join([line[0], line[1], line[2]])
-
-                indexes.append(index)
-                label_id = label_map[line[4]]
-                
-            elif args.dataset in ['MIntRec2.0', 'MIntRec2.0-OOD']:
-                index = '_'.join(['dia' + str(line[0]), 'utt' + str(line[1])])
-                indexes.append(index)
-                speaker_ids.append(args.speaker_map[line[7]])
-                label_id = label_map[line[3]]
-            
-            elif args.dataset in ['MELD-DA', 'MELD-DA-OOD']:
-                label_id = label_map[bm['label_maps'][line[3]]]
-                index = '_'.join([line[0], line[1]])
-                indexes.append(index)
+    '''
+    Parses a split file once into columns (indexes, label ids, speaker ids, texts and raw labels), 
+    which are shared by the index building and the tokenization.
+    '''
+    processor = DatasetProcessor(args)
+
+    # Read as DataProcessor.get_examples (no quote characters), so that the texts are tokenized as before
+    data = processor._read_tsv(read_file_path)
+    indexes = []
+    label_ids = []
+    speaker_ids = []
+    texts = []
+    labels = []
+
+    for i, line in enumerate(data):
+        if i == 0:
+            continue
+
+        if args.dataset in ['MIntRec', 'MIntRec-OOD']:
+            index = '_'.join([line[0], line[1], line[2]])
+
+            indexes.append(index)
+            label_id = label_map[line[4]]
             
-            elif args.dataset in ['IEMOCAP-DA', 'IEMOCAP-DA-OOD']:
-                label_id = label_map[bm['label_maps'][line[2]]]
-                index = line[0]
-                indexes.append(index)
+        elif args.dataset in ['MIntRec2.0', 'MIntRec2.0-OOD']:
+            index = '_'.join(['dia' + str(line[0]), 'utt' + str(line[1])])
+            indexes.append(index)
+            speaker_ids.append(args.speaker_map[line[7]])
+            label_id = label_map[line[3]]
+        
+        elif args.dataset in ['MELD-DA', 'MELD-DA-OOD']:
+            label_id = label_map[bm['label_maps'][line[3]]]
+            index = '_'.join([line[0], line[1]])
+            indexes.append(index)
+        
+        elif args.dataset in ['IEMOCAP-DA', 'IEMOCAP-DA-OOD']:
+            label_id = label_map[bm['label_maps'][line[2]]]
+            index = line[0]
+            indexes.append(index)
+
+        label_ids.append(label_id)
+        texts.append(line[processor.select_id])
+        labels.append(line[processor.label_id] if processor.use_label_id else None)
 
-            label_ids.append(label_id)
-    
     outputs = {
         'indexes': indexes,
         'label_ids': label_ids,
-        'speaker_ids': speaker_ids
+        'speaker_ids': speaker_ids,
+        'texts': texts,
+        'labels': labels
     }
 
     return outputs
@@ -0,0 +1,271 @@
+import os
+import pickle
+import argparse
+import numpy as np
+
+__all__ = ['FeatureStore', 'get_store_path', 'PickleFeats', 'load_pickle_feats', 'convert_pickle_to_store']
+
+FEATS_FILE = 'feats.npy'
+INDEX_FILE = 'index.npz'
+
+def get_store_path(feats_path):
+    '''
+    The feature store of 'video_data/swin_roi.pkl' is the directory 'video_data/swin_roi'.
+    '''
+    return os.path.splitext(feats_path)[0]
+
+def is_feature_store(path):
+    return os.path.isfile(os.path.join(path, FEATS_FILE)) and os.path.isfile(os.path.join(path, INDEX_FILE))
+
+class FeatureStore:
+    '''
+    Columnar storage of frame-level features:
+        feats.npy: all frames of all utterances in one contiguous [num_frames, feat_dim] array
+        index.npz: keys (utterance ids), offsets and lengths of each utterance in feats.npy
+    feats.npy is opened with np.memmap, so only the sliced utterances are read from disk.
+    '''
+    def __init__(self, store_path):
+
+        self.store_path = store_path
+        self.feats = np.load(os.path.join(store_path, FEATS_FILE), mmap_mode = 'r')
+
+        index = np.load(os.path.join(store_path, INDEX_FILE))
+        self.offsets = index['offsets']
+        self.lengths = index['lengths']
+        self.key_map = {k: i for i, k in enumerate(index['keys'].tolist())}
+
+    def __getstate__(self):
+        # The memory map is reopened instead of being pickled
+        return {'store_path': self.store_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['store_path'])
+
+    def __len__(self):
+        return len(self.key_map)
+
+    def __contains__(self, key):
+        return key in self.key_map
+
+    def keys(self):
+        return self.key_map.keys()
+
+    def __getitem__(self, key):
+
+        i = self.key_map[key]
+        st = self.offsets[i]
+
+        return self.feats[st: st + self.lengths[i]]
+
+    def get_lengths(self, keys):
+
+        return [int(self.lengths[self.key_map[k]]) for k in keys]
+
+    def load(self, keys):
+        '''
+        Reads only the features of keys into memory. They are read in the order of their offsets, 
+        so that the file is scanned sequentially whatever the order of keys.
+        '''
+        rows = np.array([self.key_map[k] for k in keys], dtype = np.int64)
+        feats = [None] * len(rows)
+
+        for i in np.argsort(self.offsets[rows], kind = 'stable'):
+            st = self.offsets[rows[i]]
+            feats[i] = np.array(self.feats[st: st + self.lengths[rows[i]]])
+
+        return feats
+
+# The chunked reader extends the pure-Python unpickler of the standard library, which is not a public API. 
+# It is only used if the unpickler still has the members it relies on, otherwise the pickles are loaded whole.
+_Unpickler = getattr(pickle, '_Unpickler', None)
+_SELECTIVE_UNPICKLING = _Unpickler is not None and isinstance(getattr(_Unpickler, 'dispatch', None), dict) \
+    and all(hasattr(_Unpickler, name) for name in ['pop_mark', 'load_setitems', 'load_setitem']) \
+    and all(op[0] in _Unpickler.dispatch for op in [pickle.SETITEMS, pickle.SETITEM, pickle.GET, pickle.BINGET, pickle.LONG_BINGET])
+
+if _SELECTIVE_UNPICKLING:
+
+    _PRUNED = object()
+
+    class _SelectiveUnpickler(_Unpickler):
+        '''
+        Unpickles a dict of features but keeps only the requested keys. The items of the top-level dict are set in chunks 
+        (1000 items per SETITEMS), and the unrequested features of each chunk are released from the stack and the memo right away, 
+        so they are never held in memory all together.
+        '''
+        def __init__(self, file, keys):
+            super().__init__(file)
+            self.keys = keys
+            self.num_checked = 0
+
+        def _release(self):
+            # Only the objects that hold feature data are released, the shared ones (classes, dtypes, small tuples) are kept
+            memo_keys = list(self.memo.keys())
+            for k in memo_keys[self.num_checked:]:
+                if _holds_data(self.memo[k]):
+                    self.memo[k] = _PRUNED
+            self.num_checked = len(memo_keys)
+
+        def load_setitems(self):
+            items = self.pop_mark()
+
+            if len(self.stack) == 1:
+                d = self.stack[-1]
+                for i in range(0, len(items), 2):
+                    if items[i] in self.keys:
+                        d[items[i]] = items[i + 1]
+                del items
+                self._release()
+            else:
+                d = self.stack[-1]
+                for i in range(0, len(items), 2):
+                    d[items[i]] = items[i + 1]
+
+        def load_setitem(self):
+            value = self.stack.pop()
+            key = self.stack.pop()
+
+            if len(self.stack) == 1:
+                if key in self.keys:
+                    self.stack[-1][key] = value
+                del value
+                self._release()
+            else:
+                self.stack[-1][key] = value
+
+        dispatch = dict(_Unpickler.dispatch)
+        dispatch[pickle.SETITEMS[0]] = load_setitems
+        dispatch[pickle.SETITEM[0]] = load_setitem
+
+    def _holds_data(obj):
+
+        if isinstance(obj, (np.ndarray, list, dict)):
+            return True
+        if isinstance(obj, (bytes, bytearray, str)):
+            # Short strings and bytes (e.g., the b'b' placeholder of numpy arrays) are shared by the items
+            return len(obj) > 64
+        if isinstance(obj, tuple):
+            return any(_holds_data(x) for x in obj)
+
+        return False
+
+    def _checked_get(load_get):
+
+        def load(self):
+            load_get(self)
+            if self.stack[-1] is _PRUNED:
+                raise pickle.UnpicklingError('A released object is referred to again.')
+
+        return load
+
+    for _op in [pickle.GET, pickle.BINGET, pickle.LONG_BINGET]:
+        _SelectiveUnpickler.dispatch[_op[0]] = _checked_get(_Unpickler.dispatch[_op[0]])
+
+def load_pickle_feats(feats_path, keys):
+    '''
+    Reads only the features of keys from a legacy pickled dict of features.
+    Falls back to loading the whole file if the features share objects that have been released, 
+    or if the chunked reader is not supported by this Python version.
+    '''
+    keys = set(keys)
+
+    if _SELECTIVE_UNPICKLING:
+        try:
+            with open(feats_path, 'rb') as f:
+                return _SelectiveUnpickler(f, keys).load()
+        except (pickle.UnpicklingError, AttributeError):
+            pass
+
+    with open(feats_path, 'rb') as f:
+        feats = pickle.load(f)
+
+    return {k: v for k, v in feats.items() if k in keys}
+
+class PickleFeats:
+    '''
+    The features of keys in a legacy pickle, with the interface of FeatureStore. 
+    They are read with load_pickle_feats on first access, so that an unused split is never read.
+    '''
+    def __init__(self, feats_path, keys):
+
+        self.feats_path = feats_path
+        self.keys = keys
+        self.feats = None
+
+    def __getstate__(self):
+        # The features are read again instead of being pickled
+        return {'feats_path': self.feats_path, 'keys': self.keys}
+
+    def __setstate__(self, state):
+        self.__init__(state['feats_path'], state['keys'])
+
+    def _load(self):
+
+        if self.feats is None:
+            self.feats = load_pickle_feats(self.feats_path, self.keys)
+
+        return self.feats
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def get_lengths(self, keys):
+
+        feats = self._load()
+
+        return [len(feats[k]) for k in keys]
+
+def convert_pickle_to_store(feats_path, store_path = None, dtype = 'float32'):
+
+    if store_path is None:
+        store_path = get_store_path(feats_path)
+
+    with open(feats_path, 'rb') as f:
+        feats = pickle.load(f)
+
+    keys = list(feats.keys())
+    lengths = np.zeros(len(keys), dtype = np.int64)
+    feat_dim = None
+
+    for i, key in enumerate(keys):
+        x = np.asarray(feats[key])
+        x = x.squeeze(1) if x.ndim == 3 else x
+
+        if x.ndim != 2:
+            raise ValueError('Error: Only frame-level features of shape [seq_len, feat_dim] can be converted, got %s for %s.' % (str(x.shape), key))
+        if feat_dim is None:
+            feat_dim = x.shape[-1]
+        elif x.shape[-1] != feat_dim:
+            raise ValueError('Error: Inconsistent feature dimensions %d and %d.' % (feat_dim, x.shape[-1]))
+
+        lengths[i] = x.shape[0]
+
+    offsets = np.zeros(len(keys), dtype = np.int64)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+
+    out = np.lib.format.open_memmap(os.path.join(store_path, FEATS_FILE), mode = 'w+', dtype = np.dtype(dtype), shape = (int(lengths.sum()), feat_dim))
+
+    for i, key in enumerate(keys):
+        x = np.asarray(feats[key])
+        x = x.squeeze(1) if x.ndim == 3 else x
+        out[offsets[i]: offsets[i] + lengths[i]] = x
+
+    out.flush()
+    del out
+
+    np.savez(os.path.join(store_path, INDEX_FILE), keys = np.array(keys), offsets = offsets, lengths = lengths)
+
+    return store_path
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Convert pickled video / audio features into a memory-mapped feature store.')
+    parser.add_argument('--feats_path', type=str, nargs='+', required=True, help="The pickled feature files, e.g., data_path/MIntRec/video_data/swin_roi.pkl.")
+    parser.add_argument('--dtype', type=str, default='float32', help="The storage dtype of the features.")
+    args = parser.parse_args()
+
+    for feats_path in args.feats_path:
+        store_path = convert_pickle_to_store(feats_path, dtype = args.dtype)
+        print('Features in %s are saved in %s' % (feats_path, store_path))
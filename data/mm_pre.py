@@ -1,15 +1,16 @@
 from torch.utils.data import Dataset
 import torch
 import numpy as np
+from .utils import pad_feats, get_text_tensors, SharedTensorDataset
 
-__all__ = ['MMDataset']
+__all__ = ['MMDataset', 'PseudoLabelDataset']
 
-class MMDataset(Dataset):
+class MMDataset(SharedTensorDataset):
         
-    def __init__(self, label_ids, text_data, video_data, audio_data, speaker_ids = None, multi_turn = False, other_hyper = None):
+    def __init__(self, label_ids, text_data, video_data, audio_data, speaker_ids = None, multi_turn = False, other_hyper = None, compact = False):
         
         self.label_ids = label_ids
-        self.text_data = text_data
+        self.text_data = get_text_tensors(text_data, multi_turn)
         self.video_data = video_data
         self.audio_data = audio_data
         self.size = len(self.text_data)
@@ -23,26 +24,123 @@ class MMDataset(Dataset):
 
         if self.other_hyper is not None:
             for key in other_hyper.keys():
-                setattr(self, key, other_hyper[key])  
+                value = other_hyper[key]
+                # The token ids and positions of the tokenization (int32 arrays) are stored as long tensors
+                if isinstance(value, np.ndarray) and np.issubdtype(value.dtype, np.integer):
+                    value = torch.as_tensor(value, dtype = torch.long)
+                setattr(self, key, value)  
+
+        # Dialogues have different numbers of utterances and cannot be stored as contiguous tensors
+        self.compact = compact and not multi_turn
+        if self.compact:
+            self._compact()
+
+    def _compact(self):
+        '''
+        Stores each field as one contiguous tensor, so that a whole batch is fetched with one index operation.
+        Ragged video and audio features are padded to the longest sequence, and each batch is cut to its longest sequence in __getitems__.
+        The features are kept in their storage dtype and cast to float32 per batch.
+        '''
+        self.label_ids = torch.as_tensor(np.asarray(self.label_ids), dtype = torch.long)
+        self.ragged = {}
+        for modality in ['video', 'audio']:
+            data = getattr(self, modality + '_data')
+            self.ragged[modality] = len(set([len(x) for x in data['feats']])) > 1
+            
+            setattr(self, modality + '_data', {
+                'feats': pad_feats(data['feats']),
+                'lengths': torch.as_tensor(np.asarray(data['lengths']), dtype = torch.long)
+            })
+
+        if self.other_hyper is not None:
+            for key in self.other_hyper.keys():
+                setattr(self, key, torch.as_tensor(np.asarray(getattr(self, key))))
+
+    def tensor_fields(self):
+
+        fields = ['label_ids', 'text_data', 'video_data.feats', 'video_data.lengths', 'audio_data.feats', 'audio_data.lengths']
+        if self.other_hyper is not None:
+            fields.extend(self.other_hyper.keys())
+
+        return fields
 
     def __len__(self):
         return self.size
 
+    def __getitems__(self, indices):
+        '''
+        Fetches a whole batch from the compact tensors.
+        '''
+        if not self.compact:
+            return [self.__getitem__(i) for i in indices]
+
+        indices = torch.as_tensor(indices, dtype = torch.long)
+
+        sample = {
+            'label_ids': self.label_ids[indices], 
+            'text_feats': self.text_data[indices],
+        }
+
+        for modality in ['video', 'audio']:
+            data = getattr(self, modality + '_data')
+            feats, lengths = data['feats'][indices], data['lengths'][indices]
+
+            if self.ragged[modality]:
+                feats = feats[:, :int(lengths.max())]
+
+            sample.update({
+                modality + '_feats': feats.float(),
+                modality + '_lengths': lengths
+            })
+
+        if self.other_hyper is not None:
+            for key in self.other_hyper.keys():
+                sample[key] = getattr(self, key)[indices]
+
+        return sample
+
     def __getitem__(self, index):
         
+        if self.compact:
+            if isinstance(index, (list, tuple)):
+                return self.__getitems__(index)
+
+            sample = {
+                'label_ids': self.label_ids[index], 
+                'text_feats': self.text_data[index],
+                'video_feats': self.video_data['feats'][index].float(),
+                'video_lengths': self.video_data['lengths'][index],
+                'audio_feats': self.audio_data['feats'][index].float(),
+                'audio_lengths': self.audio_data['lengths'][index]
+            }
+
+            if self.other_hyper is not None:
+                for key in self.other_hyper.keys():
+                    sample[key] = getattr(self, key)[index]
+
+            return sample
+
+        if self.multi_turn:
+            # The utterances of one dialogue may be ragged, pad them to the longest one
+            video_feats = pad_feats(self.video_data['feats'][index], dtype = torch.float32)
+            audio_feats = pad_feats(self.audio_data['feats'][index], dtype = torch.float32)
+        else:
+            video_feats = torch.tensor(np.asarray(self.video_data['feats'][index], dtype = np.float32))
+            audio_feats = torch.tensor(np.asarray(self.audio_data['feats'][index], dtype = np.float32))
+
         sample = {
             'label_ids': torch.tensor(self.label_ids[index]), 
-            'text_feats': torch.tensor(self.text_data[index]),
-            'video_feats': torch.tensor(np.array(self.video_data['feats'][index])),
+            'text_feats': self.text_data[index],
+            'video_feats': video_feats,
             'video_lengths': torch.tensor(np.array(self.video_data['lengths'][index])),
-            'audio_feats': torch.tensor(np.array(self.audio_data['feats'][index])),
+            'audio_feats': audio_feats,
             'audio_lengths': torch.tensor(np.array(self.audio_data['lengths'][index]))
         } 
 
         if self.other_hyper is not None:
             
             for key in self.other_hyper.keys():
-                sample[key] = torch.tensor(getattr(self, key)[index])
+                sample[key] = torch.as_tensor(getattr(self, key)[index])
 
 
         if self.multi_turn:
@@ -53,13 +151,56 @@ class MMDataset(Dataset):
 
         return sample
     
+class PseudoLabelDataset(Dataset):
+    '''
+    A view of the samples of indices (all by default) of a dataset, without copying their features.
+    The label ids of all the samples of the dataset are given as a tensor and replace those of the dataset. Each sample also has its index in the dataset (sample_ids).
+    '''
+    def __init__(self, dataset, label_ids, indices = None):
+
+        self.dataset = dataset
+        self.label_ids = torch.as_tensor(label_ids)
+        self.indices = torch.arange(len(dataset)) if indices is None else torch.as_tensor(indices, dtype = torch.long)
+
+        self.size = len(self.indices)
+        self.compact = getattr(dataset, 'compact', False)
+        self.multi_turn = False
+
+    def __len__(self):
+        return self.size
+
+    def _relabel(self, sample, sample_ids):
+
+        sample['label_ids'] = self.label_ids[sample_ids]
+        sample['sample_ids'] = sample_ids
+
+        return sample
+
+    def __getitems__(self, indices):
+
+        if not self.compact:
+            return [self.__getitem__(i) for i in indices]
+
+        sample_ids = self.indices[torch.as_tensor(indices, dtype = torch.long)]
+
+        return self._relabel(self.dataset.__getitems__(sample_ids), sample_ids)
+
+    def __getitem__(self, index):
+
+        if isinstance(index, (list, tuple)):
+            return self.__getitems__(index)
+
+        sample_id = self.indices[index]
+
+        return self._relabel(self.dataset[int(sample_id)], sample_id)
+
 def get_ood_mm_dataset(args, outputs, ood_outputs, ind_other_hyper, out_other_hyper, data):
 
     if args.train_ood:
         ood_mm_train_data = MMDataset(ood_outputs['train_label_ids'], ood_outputs['text_data']['train'], ood_outputs['video_data']['train'], \
-                                      ood_outputs['audio_data']['train'], other_hyper = out_other_hyper['train'])
+                                      ood_outputs['audio_data']['train'], other_hyper = out_other_hyper['train'], compact = args.compact_dataset)
         ood_mm_dev_data = MMDataset(ood_outputs['dev_label_ids'], ood_outputs['text_data']['dev'], ood_outputs['video_data']['dev'], \
-                                    ood_outputs['audio_data']['dev'], other_hyper = out_other_hyper['dev'])
+                                    ood_outputs['audio_data']['dev'], other_hyper = out_other_hyper['dev'], compact = args.compact_dataset)
 
         data.update({
             'ood_train': ood_mm_train_data,
@@ -68,7 +209,7 @@ def get_ood_mm_dataset(args, outputs, ood_outputs, ind_other_hyper, out_other_hy
 
     if args.test_ood:
         
-        outputs['text_data']['test'].extend(ood_outputs['text_data']['test'])
+        outputs['text_data']['test'] = np.concatenate([outputs['text_data']['test'], ood_outputs['text_data']['test']])
         outputs['test_label_ids'].extend(ood_outputs['test_label_ids'])
 
         outputs['video_data']['test']['feats'].extend(ood_outputs['video_data']['test']['feats'])
@@ -78,9 +219,9 @@ def get_ood_mm_dataset(args, outputs, ood_outputs, ind_other_hyper, out_other_hy
         outputs['audio_data']['test']['lengths'].extend(ood_outputs['audio_data']['test']['lengths'])
 
         for key in ind_other_hyper['test'].keys():
-            ind_other_hyper['test'][key].extend(out_other_hyper['test'][key])
+            ind_other_hyper['test'][key] = np.concatenate([ind_other_hyper['test'][key], out_other_hyper['test'][key]])
        
-        mm_test_data = MMDataset(outputs['test_label_ids'], outputs['text_data']['test'], outputs['video_data']['test'], outputs['audio_data']['test'], other_hyper = ind_other_hyper['test'])
+        mm_test_data = MMDataset(outputs['test_label_ids'], outputs['text_data']['test'], outputs['video_data']['test'], outputs['audio_data']['test'], other_hyper = ind_other_hyper['test'], compact = args.compact_dataset)
 
         data.update({
             'test': mm_test_data
@@ -88,17 +229,28 @@ def get_ood_mm_dataset(args, outputs, ood_outputs, ind_other_hyper, out_other_hy
 
     return data
 
-class AuGDataset(Dataset):
+class AuGDataset(SharedTensorDataset):
         
-    def __init__(self, label_ids, text_feats):
+    def __init__(self, label_ids, text_feats, compact = False):
         
         self.label_ids = torch.tensor(label_ids)
-        self.text_feats = torch.tensor(text_feats)
+        self.text_feats = get_text_tensors(text_feats)
         self.size = len(self.text_feats)
+        self.compact = compact
+
+    def tensor_fields(self):
+        return ['label_ids', 'text_feats']
 
     def __len__(self):
         return self.size
 
+    def __getitems__(self, indices):
+
+        if not self.compact:
+            return [self.__getitem__(i) for i in indices]
+
+        return self.__getitem__(torch.as_tensor(indices, dtype = torch.long))
+
     def __getitem__(self, index):
 
         sample = {
@@ -1,10 +1,17 @@
 import os
 import csv
 import sys
+import json
+import hashlib
+import functools
+import multiprocessing
 import torch
 import numpy as np
-from transformers import BertTokenizer, RobertaTokenizer, T5Tokenizer    #XCLIPProcessor
+from transformers import BertTokenizerFast    #XCLIPProcessor
 from torch.utils.data import Dataset
+from .utils import SharedTensorDataset, get_text_tensors
+
+_tokenizers = {}
 
 def get_t_data(args, data_args):
     
@@ -25,14 +32,15 @@ def get_data(args, data_args):
         data_path = data_args['text_data_path']
     else:
         data_path = data_args['data_path']
+    annotations = data_args.get('annotations', {})
     outputs = {}
 
     if 'train_data_index' in data_args:
         
-        train_examples = processor.get_examples(data_path, 'train') 
+        train_examples = processor.get_examples(data_path, 'train', annotations.get('train')) 
         train_feats = get_backbone_feats(args, train_examples)
         
-        dev_examples = processor.get_examples(data_path, 'dev')
+        dev_examples = processor.get_examples(data_path, 'dev', annotations.get('dev'))
         dev_feats = get_backbone_feats(args, dev_examples)
 
         for key in train_feats.keys():
@@ -44,7 +52,7 @@ def get_data(args, data_args):
             outputs.update(tmp_outputs)
     
     if 'test_data_index' in data_args:
-        test_examples = processor.get_examples(data_path, 'test')
+        test_examples = processor.get_examples(data_path, 'test', annotations.get('test'))
         test_feats = get_backbone_feats(args, test_examples)
 
         for key in test_feats.keys():
@@ -54,7 +62,7 @@ def get_data(args, data_args):
                 outputs[key] = {'test': test_feats[key]}
 
     if 'augment_data_index' in data_args:
-        augment_examples = processor.get_examples(data_path, 'aug') 
+        augment_examples = processor.get_examples(data_path, 'aug', annotations.get('aug')) 
         augment_feats = get_backbone_feats(args, augment_examples)
 
         for key in augment_feats.keys():
@@ -67,16 +75,21 @@ def get_clu_data(args, data_args):
 
     processor = DatasetProcessor(args)
     data_path = data_args['data_path']
+    annotations = data_args.get('annotations', {})
 
-    train_examples = processor.get_examples(data_path, 'train') 
-    dev_examples = processor.get_examples(data_path, 'dev')
+    # The train and dev annotations are already merged
+    if 'train' in annotations:
+        train_examples = processor.get_examples(data_path, 'train', annotations['train'])
+    else:
+        train_examples = processor.get_examples(data_path, 'train') 
+        dev_examples = processor.get_examples(data_path, 'dev')
 
-    train_examples = train_examples + dev_examples
+        train_examples = train_examples + dev_examples
 
     train_feats = get_backbone_feats(args, train_examples)
 
     
-    test_examples = processor.get_examples(data_path, 'test')
+    test_examples = processor.get_examples(data_path, 'test', annotations.get('test'))
     test_feats = get_backbone_feats(args, test_examples)
 
     
@@ -90,29 +103,94 @@ def get_clu_data(args, data_args):
 
 def get_backbone_feats(args, examples):
     
-    if args.text_backbone.startswith('bert'):
-        tokenizer = BertTokenizer.from_pretrained(args.text_pretrained_model, do_lower_case=True)   
-
     if args.text_backbone.startswith(('bert')):
 
-        outputs = convert_examples_to_features(args, examples, tokenizer)   
-        features = outputs['features']
-        features_list = [[feat.input_ids, feat.input_mask, feat.segment_ids] for feat in features]
+        tokenizer = get_tokenizer(args)
 
-        outputs['features'] = features_list
+        cache_file = None
+        if args.data_cache_path is not None:
+            cache_file = get_text_cache_file(args, examples)
 
+        if cache_file is not None and os.path.exists(cache_file):
+            outputs = load_text_cache(cache_file)
+        else:
+            outputs = convert_examples_to_features(args, examples, tokenizer)
+            if cache_file is not None:
+                save_text_cache(cache_file, outputs)
+
+        # The int32 arrays are converted into tensors by the datasets
         if args.method == 'tcl_map':
-            cons_text_feats = outputs['cons_text_feats']
-            cons_text_feats = [[feat.input_ids, feat.input_mask, feat.segment_ids] for feat in cons_text_feats]
-            outputs['cons_text_feats'] = cons_text_feats
+            args.max_cons_seq_length = outputs['features'].shape[-1]
 
         return outputs
-    
+
+def get_tokenizer(args):
+    '''
+    The tokenizer is loaded once and shared by all splits.
+    '''
+    if args.text_pretrained_model not in _tokenizers:
+        _tokenizers[args.text_pretrained_model] = BertTokenizerFast.from_pretrained(args.text_pretrained_model, do_lower_case=True)
+
+    return _tokenizers[args.text_pretrained_model]
+
+def get_text_cache_file(args, examples):
+    '''
+    The token ids of a split are cached by the tokenizer settings and the texts (and labels for TCL-MAP) of the split.
+    '''
+    infos = {
+        'text_pretrained_model': args.text_pretrained_model,
+        'method': args.method,
+        'dataset': args.dataset,
+        'text_seq_len': args.text_seq_len,
+        'label_len': args.label_len if args.method == 'tcl_map' else None,
+        'examples': [(example.text_a, example.text_b, example.label) for example in examples]
+    }
+    fingerprint = hashlib.md5(json.dumps(infos, default = str).encode('utf-8')).hexdigest()
+
+    return os.path.join(args.data_cache_path, 'text', '_'.join([args.dataset, args.method, fingerprint]) + '.npz')
+
+def load_text_cache(cache_file):
+
+    with np.load(cache_file) as f:
+        outputs = {key: f[key] for key in f.files}
+
+    return outputs
+
+def save_text_cache(cache_file, outputs):
+
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok = True)
+
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **outputs)
+    os.replace(tmp_file, cache_file)
+
+def _tokenize(tokenizer, texts):
+
+    return tokenizer(texts, add_special_tokens = False)['input_ids']
+
+def batch_tokenize(tokenizer, texts, num_workers = 0, chunk_size = 2048):
+    '''
+    Tokenizes a list of texts into lists of token ids (without special tokens).
+    The fast tokenizer encodes each chunk in one batched call, and the chunks are spread over num_workers processes if num_workers > 1.
+    '''
+    chunks = [texts[i: i + chunk_size] for i in range(0, len(texts), chunk_size)]
+
+    if num_workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(min(num_workers, len(chunks))) as pool:
+            results = pool.map(functools.partial(_tokenize, tokenizer), chunks)
+    else:
+        results = [_tokenize(tokenizer, chunk) for chunk in chunks]
+
+    return [ids for chunk in results for ids in chunk]
+
 def get_ood_text_dataset(args, outputs, ood_outputs, data):
 
     if args.train_ood:
-        ood_text_train_data = TextDataset(ood_outputs['train_label_ids'], ood_outputs['text_data']['train'])
-        ood_text_dev_data = TextDataset(ood_outputs['dev_label_ids'], ood_outputs['text_data']['dev'])
+        ood_text_train_data = TextDataset(ood_outputs['train_label_ids'], ood_outputs['text_data']['train'], compact = args.compact_dataset)
+        ood_text_dev_data = TextDataset(ood_outputs['dev_label_ids'], ood_outputs['text_data']['dev'], compact = args.compact_dataset)
 
         data.update({
         'ood_train': ood_text_train_data,
@@ -120,10 +198,10 @@ def get_ood_text_dataset(args, outputs, ood_outputs, data):
         })
 
     if args.test_ood:
-        outputs['text_data']['test'].extend(ood_outputs['text_data']['test'])
+        outputs['text_data']['test'] = np.concatenate([outputs['text_data']['test'], ood_outputs['text_data']['test']])
         outputs['test_label_ids'].extend(ood_outputs['test_label_ids'])
 
-    ood_text_test_data = TextDataset(outputs['test_label_ids'], outputs['text_data']['test'])
+    ood_text_test_data = TextDataset(outputs['test_label_ids'], outputs['text_data']['test'], compact = args.compact_dataset)
                 
     data.update({
         'test': ood_text_test_data
@@ -190,8 +268,11 @@ class DatasetProcessor(DataProcessor):
             self.select_id = 1
             self.label_id = 2
         
-    def get_examples(self, data_dir, mode):
+    def get_examples(self, data_dir, mode, annotations = None):
         
+        if annotations is not None:
+            return self._create_annotation_examples(annotations, 'train' if mode == 'dev' else mode)
+
         if mode == 'train':
             return self._create_examples(
                 self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
@@ -225,11 +306,43 @@ class DatasetProcessor(DataProcessor):
                 InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
         return examples
 
-def convert_examples_to_features(args, examples, tokenizer):
+    def _create_annotation_examples(self, annotations, set_type):
+        """Creates examples from the parsed annotations of get_indexes_annotations."""
+        examples = []
 
+        for (i, (text_a, label)) in enumerate(zip(annotations['texts'], annotations['labels'])):
+
+            guid = "%s-%s" % (set_type, i + 1)
+            examples.append(
+                InputExample(guid=guid, text_a=text_a, text_b=None, label=label))
+        return examples
+
+def convert_examples_to_features(args, examples, tokenizer):
+    '''
+    Returns int32 arrays: features [num_examples, 3 (input_ids, input_mask, segment_ids), seq_len], 
+    and for TCL-MAP also cons_text_feats of the same shape and condition_idx [num_examples].
+    '''
     max_seq_length = args.text_seq_len
-        
-    outputs = {}
+    num_workers = args.num_tokenize_workers
+
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+    tokens_a_list = batch_tokenize(tokenizer, [example.text_a for example in examples], num_workers)
+
+    tokens_b_list = [None] * len(examples)
+    b_index = [i for i, example in enumerate(examples) if example.text_b]
+    if len(b_index) > 0:
+        for i, tokens_b in zip(b_index, batch_tokenize(tokenizer, [examples[i].text_b for i in b_index], num_workers)):
+            tokens_b_list[i] = tokens_b
+
+    for tokens_a, tokens_b in zip(tokens_a_list, tokens_b_list):
+        if tokens_b is not None:
+            # Modifies `tokens_a` and `tokens_b` in place so that the total
+            # length is less than the specified length.
+            # Account for [CLS], [SEP], [SEP] with "- 3"
+            _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
+        else:
+            # Account for [CLS] and [SEP] with "- 2"
+            del tokens_a[max_seq_length - 2:]
 
     if args.method == 'tcl_map':
         
@@ -239,70 +352,43 @@ def convert_examples_to_features(args, examples, tokenizer):
                     'a': 'Acknowledge', 'b': 'Backchannel', 'oth': 'Others'
         }
         label_len = args.label_len
-        features = []
-        cons_features = []
-        condition_idx = []
         prefix = ['MASK'] * 3
 
+        prefix_ids = tokenizer.convert_tokens_to_ids(prefix)
+        mask_id, cons_mask_id = tokenizer.convert_tokens_to_ids(["[MASK]", "MASK"])
+
+        # Each label is tokenized only once
+        conditions = {}
+        for example in examples:
+            if example.label not in conditions:
+                label = example.label if args.dataset in ['MIntRec'] else label_maps[example.label]
+                conditions[example.label] = tokenizer.convert_tokens_to_ids(tokenizer.tokenize(label))
+
         max_cons_seq_length = max_seq_length + len(prefix) + label_len
-        for (ex_index, example) in enumerate(examples):
-            tokens_a = tokenizer.tokenize(example.text_a)
-            if args.dataset in ['MIntRec']:
-                condition = tokenizer.tokenize(example.label)
-            elif args.dataset in ['MELD-DA', 'IEMOCAP-DA']:
-                condition = tokenizer.tokenize(label_maps[example.label])
-
-            tokens_b = None
-            if example.text_b:
-                tokens_b = tokenizer.tokenize(example.text_b)
-                # Modifies `tokens_a` and `tokens_b` in place so that the total
-                # length is less than the specified length.
-                # Account for [CLS], [SEP], [SEP] with "- 3"
-                _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-            else:
-                # Account for [CLS] and [SEP] with "- 2"
-                if len(tokens_a) > max_seq_length - 2:
-                    tokens_a = tokens_a[:(max_seq_length - 2)]
+
+        features = np.zeros((len(examples), 3, max_cons_seq_length), dtype = np.int32)
+        cons_features = np.zeros((len(examples), 3, max_cons_seq_length), dtype = np.int32)
+        condition_idx = np.zeros(len(examples), dtype = np.int32)
+
+        for i, (example, tokens_a) in enumerate(zip(examples, tokens_a_list)):
+            condition = conditions[example.label]
 
             # construct augmented sample pair
-            cons_tokens = ["[CLS]"] + tokens_a + prefix + condition + (label_len - len(condition)) * ["MASK"] + ["[SEP]"]
-            tokens = ["[CLS]"] + tokens_a + prefix + label_len * ["[MASK]"] + ["[SEP]"]
+            cons_input_ids = [cls_id] + tokens_a + prefix_ids + condition + (label_len - len(condition)) * [cons_mask_id] + [sep_id]
+            input_ids = [cls_id] + tokens_a + prefix_ids + label_len * [mask_id] + [sep_id]
 
-            segment_ids = [0] * len(tokens)
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
-            cons_inputs_ids = tokenizer.convert_tokens_to_ids(cons_tokens)
-            # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            padding = [0] * (max_cons_seq_length - len(input_ids))
-            input_ids += padding
-            cons_inputs_ids += padding
-            input_mask += padding
-            segment_ids += padding
-
-            assert len(input_ids) == max_cons_seq_length
-            assert len(cons_inputs_ids) == max_cons_seq_length
-            assert len(input_mask) == max_cons_seq_length
-            assert len(segment_ids) == max_cons_seq_length
-            # record the position of prompt
-            condition_idx.append(1 + len(tokens_a) + len(prefix))
+            assert len(input_ids) <= max_cons_seq_length
+            assert len(cons_input_ids) == len(input_ids)
 
+            # The mask has 1 for real tokens and 0 for padding tokens, and the segment ids are all 0
+            features[i, 0, :len(input_ids)] = input_ids
+            features[i, 1, :len(input_ids)] = 1
+            cons_features[i, 0, :len(input_ids)] = cons_input_ids
+            cons_features[i, 1, :len(input_ids)] = 1
 
-            features.append(
-                InputFeatures(input_ids=input_ids,
-                            input_mask=input_mask,
-                            segment_ids=segment_ids)
-                            )
-            
-            cons_features.append(
-                InputFeatures(input_ids=cons_inputs_ids,
-                            input_mask=input_mask,
-                            segment_ids=segment_ids)
-                            )
+            # record the position of prompt
+            condition_idx[i] = 1 + len(tokens_a) + len(prefix)
         
-        args.max_cons_seq_length = max_cons_seq_length
         outputs = {
             'features': features,
             'cons_text_feats': cons_features,
@@ -310,22 +396,9 @@ def convert_examples_to_features(args, examples, tokenizer):
         }
 
     else:   
-        features = []
-        for (ex_index, example) in enumerate(examples):
-            tokens_a = tokenizer.tokenize(example.text_a)
-
-            tokens_b = None
-            if example.text_b:
-                tokens_b = tokenizer.tokenize(example.text_b)
-                # Modifies `tokens_a` and `tokens_b` in place so that the total
-                # length is less than the specified length.
-                # Account for [CLS], [SEP], [SEP] with "- 3"
-                _truncate_seq_pair(tokens_a, tokens_b, max_seq_length - 3)
-            else:
-                # Account for [CLS] and [SEP] with "- 2"
-                if len(tokens_a) > max_seq_length - 2:
-                    tokens_a = tokens_a[:(max_seq_length - 2)]
+        features = np.zeros((len(examples), 3, max_seq_length), dtype = np.int32)
 
+        for i, (tokens_a, tokens_b) in enumerate(zip(tokens_a_list, tokens_b_list)):
             # The convention in BERT is:
             # (a) For sequence pairs:
             #  tokens:   [CLS] is this jack ##son ##ville ? [SEP] no it is not . [SEP]
@@ -333,59 +406,22 @@ def convert_examples_to_features(args, examples, tokenizer):
             # (b) For single sequences:
             #  tokens:   [CLS] the dog is hairy . [SEP]
             #  type_ids: 0   0   0   0  0     0 0
-            #
-            # Where "type_ids" are used to indicate whether this is the first
-            # sequence or the second sequence. The embedding vectors for `type=0` and
-            # `type=1` were learned during pre-training and are added to the wordpiece
-            # embedding vector (and position vector). This is not *strictly* necessary
-            # since the [SEP] token unambigiously separates the sequences, but it makes
-            # it easier for the model to learn the concept of sequences.
-            #
-            # For classification tasks, the first vector (corresponding to [CLS]) is
-            # used as as the "sentence vector". Note that this only makes sense because
-            # the entire model is fine-tuned.
-            tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
-            segment_ids = [0] * len(tokens)
+            input_ids = [cls_id] + tokens_a + [sep_id]
+            len_a = len(input_ids)
 
             if tokens_b:
-                tokens += tokens_b + ["[SEP]"]
-                segment_ids += [1] * (len(tokens_b) + 1)
-
-            input_ids = tokenizer.convert_tokens_to_ids(tokens)
+                input_ids += tokens_b + [sep_id]
+                features[i, 2, len_a: len(input_ids)] = 1
 
             # The mask has 1 for real tokens and 0 for padding tokens. Only real
-            # tokens are attended to.
-            input_mask = [1] * len(input_ids)
-
-            # Zero-pad up to the sequence length.
-            padding = [0] * (max_seq_length - len(input_ids))
-            input_ids += padding
-            input_mask += padding
-            segment_ids += padding
-
-            assert len(input_ids) == max_seq_length
-            assert len(input_mask) == max_seq_length
-            assert len(segment_ids) == max_seq_length
-
-            # if ex_index < 5:
-            #     logger.info("*** Example ***")
-            #     logger.info("guid: %s" % (example.guid))
-            #     logger.info("tokens: %s" % " ".join(
-            #         [str(x) for x in tokens]))
-            #     logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            #     logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            #     logger.info(
-            #         "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-
-            features.append(
-                InputFeatures(input_ids=input_ids,
-                            input_mask=input_mask,
-                            segment_ids=segment_ids)
-                            )
+            # tokens are attended to. The rest is zero-padded up to the sequence length.
+            features[i, 0, :len(input_ids)] = input_ids
+            features[i, 1, :len(input_ids)] = 1
         
         outputs = {
             'features': features
         }
+
     return outputs
 
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
@@ -403,24 +439,53 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
         else:
             tokens_b.pop()
 
-class TextDataset(Dataset):
+class TextDataset(SharedTensorDataset):
     
-    def __init__(self, label_ids, text_feats, speaker_ids = None, multi_turn = False):
+    def __init__(self, label_ids, text_feats, speaker_ids = None, multi_turn = False, compact = False):
         
         self.label_ids = label_ids
-        self.text_feats = text_feats
+        self.text_feats = get_text_tensors(text_feats, multi_turn)
         self.size = len(self.text_feats)
 
         self.speaker_ids = speaker_ids
         self.multi_turn = multi_turn
 
+        # Stores the features as contiguous tensors, so that a whole batch is fetched with one index operation
+        self.compact = compact and not multi_turn
+        if self.compact:
+            self.label_ids = torch.as_tensor(np.asarray(label_ids), dtype = torch.long)
+
+    def tensor_fields(self):
+        return ['label_ids', 'text_feats']
+
     def __len__(self):
         return self.size
 
+    def __getitems__(self, indices):
+
+        if not self.compact:
+            return [self.__getitem__(i) for i in indices]
+
+        indices = torch.as_tensor(indices, dtype = torch.long)
+
+        return {
+            'text_feats': self.text_feats[indices],
+            'label_ids': self.label_ids[indices],
+        }
+
     def __getitem__(self, index):
 
+        if self.compact:
+            if isinstance(index, (list, tuple)):
+                return self.__getitems__(index)
+
+            return {
+                'text_feats': self.text_feats[index],
+                'label_ids': self.label_ids[index],
+            }
+
         sample = {
-            'text_feats': torch.tensor(self.text_feats[index]),
+            'text_feats': self.text_feats[index],
             'label_ids': torch.tensor(self.label_ids[index]), 
         } 
         
@@ -1,13 +1,192 @@
 import pickle
 import numpy as np
 import os
+import glob
+import json
+import hashlib
 import torch
-from torch.utils.data import DataLoader, WeightedRandomSampler, RandomSampler
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, WeightedRandomSampler, RandomSampler, SequentialSampler, BatchSampler, Sampler
+from torch.utils.data.dataloader import default_collate
 from collections import Counter
 from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence
 import torch.nn.utils.rnn as rnn_utils
 import random
+from .feature_store import FeatureStore, PickleFeats, get_store_path, is_feature_store, load_pickle_feats, FEATS_FILE, INDEX_FILE
+
+MM_FEATS_KEYS = ['video_feats', 'audio_feats']
+
+def get_text_tensors(text_feats, multi_turn = False):
+    '''
+    The token ids [num_examples, 3, seq_len] of the tokenization (int32 arrays) as a long tensor, 
+    or a dict {dialogue index: long tensor of its utterances} for multi-turn data.
+    '''
+    if multi_turn:
+        return {i: torch.as_tensor(np.asarray(x), dtype = torch.long) for i, x in text_feats.items()}
+
+    return torch.as_tensor(np.asarray(text_feats), dtype = torch.long)
+
+def pad_feats(feats, max_seq_len = None, dtype = None):
+    '''
+    Pads a list of [seq_len, feat_dim] features with zeros to the longest sequence (at most max_seq_len).
+    '''
+    feats = [torch.as_tensor(np.asarray(x), dtype = dtype) for x in feats]
+    padded_feats = rnn_utils.pad_sequence(feats, batch_first = True)
+
+    if max_seq_len is not None:
+        padded_feats = padded_feats[:, :max_seq_len]
+
+    return padded_feats
+
+def share_tensor(tensor, file_path):
+    '''
+    Saves a tensor to file_path in a shared-memory directory (e.g., /dev/shm) unless it exists, and maps it back.
+    All processes on the host that map the same file share one physical copy of the data.
+    '''
+    if not os.path.exists(file_path):
+        tmp_file = '%s.%d.tmp' % (file_path, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, tensor.numpy())
+        os.replace(tmp_file, file_path)
+
+    # Copy-on-write mapping: the pages are shared as long as they are only read
+    return torch.from_numpy(np.load(file_path, mmap_mode = 'c'))
+
+class SharedTensorDataset(Dataset):
+    '''
+    A compact dataset whose tensors can be moved to shared memory by share_memory(prefix).
+    The shared tensors are pickled as file references, so DataLoader workers and other runs on the host map the same memory 
+    instead of holding their own copies.
+    '''
+    shared_files = None
+
+    def tensor_fields(self):
+        '''
+        The names of the tensors, with '.' for the keys of dict attributes (e.g., 'video_data.feats').
+        '''
+        raise NotImplementedError
+
+    def _get_field(self, name):
+
+        obj = self
+        for key in name.split('.'):
+            obj = obj[key] if isinstance(obj, dict) else getattr(obj, key)
+        return obj
+
+    def _set_field(self, name, value):
+
+        keys = name.split('.')
+        obj = getattr(self, keys[0]) if len(keys) > 1 else self
+        for key in keys[1:-1]:
+            obj = obj[key]
+        
+        if isinstance(obj, dict):
+            obj[keys[-1]] = value
+        else:
+            setattr(obj, keys[-1], value)
+
+    def share_memory(self, prefix):
+
+        self.shared_files = {}
+        for name in self.tensor_fields():
+            file_path = '%s_%s.npy' % (prefix, name)
+            self._set_field(name, share_tensor(self._get_field(name), file_path))
+            self.shared_files[name] = file_path
+
+        return self
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+
+        if self.shared_files is not None:
+            for name in self.shared_files.keys():
+                keys = name.split('.')
+                if len(keys) == 1:
+                    state[keys[0]] = None
+                else:
+                    state[keys[0]] = dict(state[keys[0]])
+                    state[keys[0]][keys[1]] = None
+
+        return state
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+
+        if self.shared_files is not None:
+            for name, file_path in self.shared_files.items():
+                self._set_field(name, torch.from_numpy(np.load(file_path, mmap_mode = 'c')))
+
+def erase_positions(x, mask, erase, max_seq_len):
+    '''
+    Deletes the erased positions of x [batch_size, seq_len, ...] and mask [batch_size, seq_len], shifts the kept positions to the front
+    (with one stable sort and gather), and zero-pads or truncates the results to max_seq_len.
+    '''
+    keep = ~erase
+    order = torch.sort((~keep).to(torch.int8), dim = 1, stable = True)[1]
+    kept = torch.arange(x.shape[1], device = x.device).unsqueeze(0) < keep.sum(1, keepdim = True)
+
+    x_order = order.view(order.shape + (1,) * (x.dim() - 2)).expand_as(x)
+    x = x.gather(1, x_order) * kept.view(kept.shape + (1,) * (x.dim() - 2)).to(x.dtype)
+    mask = mask.gather(1, order) * kept.to(mask.dtype)
+
+    pad_len = max_seq_len - x.shape[1]
+    x = F.pad(x, (0, 0) * (x.dim() - 2) + (0, pad_len))
+    mask = F.pad(mask, (0, pad_len))
+
+    return x, mask
+
+def random_token_erase(input_ids, input_mask, special_ids, re_prob, max_seq_len = None):
+    '''
+    Erases int(re_prob * n) random tokens of each text, where n is its number of tokens that are not special tokens (special_ids, e.g., [CLS], [SEP] and [PAD]).
+    All the texts of the batch are erased at once on their device.
+    '''
+    max_seq_len = input_ids.shape[1] if max_seq_len is None else max_seq_len
+
+    candidates = ~torch.isin(input_ids, special_ids.to(input_ids.device))
+    num_erased = (candidates.sum(1, keepdim = True) * re_prob).long()
+
+    # A random order of the candidates of each text, the first num_erased of which are erased
+    scores = torch.rand(input_ids.shape, device = input_ids.device).masked_fill(~candidates, 2.0)
+    ranks = scores.argsort(1).argsort(1)
+    erase = ranks < num_erased
+
+    return erase_positions(input_ids, input_mask, erase, max_seq_len)
+
+def random_frame_erase(feats, feats_mask, re_prob, max_seq_len = None):
+    '''
+    Erases a random span of the valid frames of each video or audio: it starts at a random valid frame s of the n valid ones 
+    and covers max(1, int(re_prob * (n - s))) frames. All the sequences of the batch are erased at once on their device.
+    '''
+    max_seq_len = feats.shape[1] if max_seq_len is None else max_seq_len
+
+    valid = feats_mask.bool()
+    num_valid = valid.sum(1, keepdim = True)
+    frame_ranks = valid.long().cumsum(1) - 1
+
+    erase_start = (torch.rand(num_valid.shape, device = feats.device) * num_valid).long()
+    erase_end = torch.minimum(erase_start + (re_prob * (num_valid - erase_start)).long().clamp(min = 1), num_valid)
+    erase = valid & (frame_ranks >= erase_start) & (frame_ranks < erase_end)
+
+    return erase_positions(feats, feats_mask, erase, max_seq_len)
+
+def mm_collate_fn(batch):
+    '''
+    Pads the (ragged) video and audio features to the longest sequence in the batch.
+    '''
+    batch_keys = batch[0].keys()
+    batch_dicts = {}
+
+    for key in batch_keys:
+        
+        if key in MM_FEATS_KEYS:
+            batch_dicts[key] = pad_feats([s[key] for s in batch])
+        else:
+            batch_dicts[key] = default_collate([s[key] for s in batch])
+
+    return batch_dicts
 
 def dialog_collate_fn(batch):
     
@@ -16,16 +195,122 @@ def dialog_collate_fn(batch):
     
     for key in batch_keys:
 
-        batch_dicts[key] = rnn_utils.pad_sequence([s[key] for s in batch], batch_first = True)
+        if key in MM_FEATS_KEYS:
+            # Dialogues are padded to the same number of utterances and the same number of frames
+            max_seq_len = max([s[key].shape[1] for s in batch])
+            feats = [F.pad(s[key], (0, 0, 0, max_seq_len - s[key].shape[1])) for s in batch]
+            batch_dicts[key] = rnn_utils.pad_sequence(feats, batch_first = True)
+        else:
+            batch_dicts[key] = rnn_utils.pad_sequence([s[key] for s in batch], batch_first = True)
 
     return batch_dicts
     
+class LengthBucketBatchSampler(Sampler):
+    '''
+    Groups samples of similar lengths into the same batch.
+    In each epoch, the samples are shuffled and split into buckets of bucket_size batches. 
+    Each bucket is sorted by lengths and split into batches, and then all batches are shuffled.
+    '''
+    def __init__(self, lengths, batch_size, bucket_size = 50, drop_last = False):
+        
+        lengths = np.asarray(lengths)
+        self.lengths = lengths.reshape(len(lengths), -1)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+
+    def __len__(self):
+
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+
+        # Draw the seed from the torch generator, so that the batches are reproducible under set_torch_seed but differ across epochs
+        seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        rng = np.random.RandomState(seed % (2 ** 32))
+
+        indices = rng.permutation(len(self.lengths))
+        bucket_len = self.batch_size * self.bucket_size
+
+        batches = []
+        for st in range(0, len(indices), bucket_len):
+            bucket = indices[st: st + bucket_len]
+            # Sort by the first length, then the second, ...
+            bucket = bucket[np.lexsort(self.lengths[bucket].T[::-1])]
+            batches.extend([bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size)])
+
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        
+        for i in rng.permutation(len(batches)):
+            yield batches[i].tolist()
+
+def get_sort_lengths(dataset):
+    '''
+    Multi-turn dialogues are sorted by the number of utterances, and single-turn utterances by the audio and video lengths
+    (by the text lengths if the dataset has no audio and video, e.g., TextDataset).
+    '''
+    if hasattr(dataset, 'indices'):
+        # A view of the samples of a dataset
+        return get_sort_lengths(dataset.dataset)[dataset.indices.numpy()]
+
+    if dataset.multi_turn:
+        # The labels of the dialogues are a dict {dialogue index: utterance labels}
+        return np.array([len(dataset.label_ids[i]) for i in range(len(dataset))])
+
+    if not hasattr(dataset, 'audio_data') or not hasattr(dataset, 'video_data'):
+        # The sum of input_mask of [input_ids, input_mask, segment_ids]
+        text_feats = dataset.text_feats
+        text_feats = text_feats.numpy() if isinstance(text_feats, torch.Tensor) else np.asarray(text_feats)
+        return text_feats[:, 1].sum(-1)
+
+    return np.stack([np.asarray(dataset.audio_data['lengths']), np.asarray(dataset.video_data['lengths'])], axis = 1)
+
+def get_batch_sampler(args, dataset, batch_size, drop_last = False):
+
+    return LengthBucketBatchSampler(get_sort_lengths(dataset), batch_size, args.bucket_size, drop_last)
+
+def get_collate_fn(args):
+
+    return mm_collate_fn if args.dynamic_padding else None
+
+def build_dataloader(dataset, batch_size = 1, shuffle = False, batch_sampler = None, collate_fn = None, **kwargs):
+    '''
+    A compact dataset returns a whole batch from dataset[indices], so its batch sampler is passed as the sampler 
+    and automatic batching (and collate_fn) is disabled. Other datasets are loaded sample by sample as usual.
+    '''
+    if getattr(dataset, 'compact', False):
+        if batch_sampler is None:
+            sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last = False)
+
+        return DataLoader(dataset, sampler = batch_sampler, batch_size = None, **kwargs)
+
+    if batch_sampler is not None:
+        return DataLoader(dataset, batch_sampler = batch_sampler, collate_fn = collate_fn, **kwargs)
+
+    return DataLoader(dataset, shuffle = shuffle, batch_size = batch_size, collate_fn = collate_fn, **kwargs)
+
+def get_subset_dataloader(args, dataset, indices, batch_size):
+    '''
+    Iterates over the samples of indices (in their order) without building a new dataset.
+    '''
+    batch_sampler = BatchSampler(list(indices), batch_size, drop_last = False)
+
+    return build_dataloader(dataset, batch_sampler = batch_sampler, num_workers = args.num_workers, pin_memory = True, collate_fn = get_collate_fn(args))
+
 def get_dataloader(args, data, weighted = False):
 
     if args.dialogue_mode == 'multi_turn':
-        train_dataloader = DataLoader(data['train'], shuffle=True, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
-        dev_dataloader = DataLoader(data['dev'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
-        test_dataloader = DataLoader(data['test'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
+        if args.length_bucketing:
+            train_dataloader = build_dataloader(data['train'], batch_sampler = get_batch_sampler(args, data['train'], args.train_batch_size), num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
+        else:
+            train_dataloader = build_dataloader(data['train'], shuffle=True, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
+        dev_dataloader = build_dataloader(data['dev'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
+        test_dataloader = build_dataloader(data['test'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = dialog_collate_fn)
 
         dataloader = {
             'train': train_dataloader,
@@ -34,9 +319,11 @@ def get_dataloader(args, data, weighted = False):
         } 
 
     else: 
+        collate_fn = get_collate_fn(args)
+
         if args.clustering:
-            train_dataloader = DataLoader(data['train'], shuffle=False, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = True)
-            test_dataloader = DataLoader(data['test'], batch_size = args.test_batch_size, num_workers = args.num_workers, pin_memory = True)
+            train_dataloader = build_dataloader(data['train'], shuffle=False, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = collate_fn)
+            test_dataloader = build_dataloader(data['test'], batch_size = args.test_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = collate_fn)
 
             dataloader = {
                 'train': train_dataloader,
@@ -44,17 +331,20 @@ def get_dataloader(args, data, weighted = False):
             }  
 
         else:
-            train_dataloader = DataLoader(data['train'], shuffle=True, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = True)
+            if args.length_bucketing:
+                train_dataloader = build_dataloader(data['train'], batch_sampler = get_batch_sampler(args, data['train'], args.train_batch_size), num_workers = args.num_workers, pin_memory = True, collate_fn = collate_fn)
+            else:
+                train_dataloader = build_dataloader(data['train'], shuffle=True, batch_size = args.train_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = collate_fn)
 
-            dev_dataloader = DataLoader(data['dev'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True)
+            dev_dataloader = build_dataloader(data['dev'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = collate_fn)
             
             if args.train_ood:
-                ood_train_dataloader = DataLoader(data['ood_train'], shuffle = True, batch_size = args.train_batch_size, pin_memory = True)
-                ood_dev_dataloader = DataLoader(data['ood_dev'], batch_size = args.eval_batch_size, pin_memory = True)
+                ood_train_dataloader = build_dataloader(data['ood_train'], shuffle = True, batch_size = args.train_batch_size, pin_memory = True, collate_fn = collate_fn)
+                ood_dev_dataloader = build_dataloader(data['ood_dev'], batch_size = args.eval_batch_size, pin_memory = True, collate_fn = collate_fn)
 
-            test_dataloader = DataLoader(data['test'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True)
+            test_dataloader = build_dataloader(data['test'], batch_size = args.eval_batch_size, num_workers = args.num_workers, pin_memory = True, collate_fn = collate_fn)
             if args.aug:
-                aug_dataloader = DataLoader(data['aug'], shuffle=True, batch_size = args.aug_batch_size)
+                aug_dataloader = build_dataloader(data['aug'], shuffle=True, batch_size = args.aug_batch_size)
 
             
             dataloader = {
@@ -75,34 +365,108 @@ def get_dataloader(args, data, weighted = False):
         
     return dataloader
 
-def get_v_a_data(data_args, feats_path, max_seq_len):
+def get_v_a_data(data_args, feats_path, max_seq_len, ragged = False, dtype = 'float32'):
     
-    if not os.path.exists(feats_path):
+    store_path = get_store_path(feats_path)
+    if is_feature_store(store_path):
+        feats_path = store_path
+    elif not os.path.exists(feats_path):
         raise Exception('Error: The directory of features is empty.')    
 
     feats = load_feats(data_args, feats_path)
-    data = padding_feats(feats, max_seq_len)
+    data = padding_feats(feats, max_seq_len, ragged, dtype)
+
+    # The features of the lazy splits are only read when they are accessed, from the feature store or the legacy pickle
+    for mode in data_args.get('lazy_modes', []):
+        if mode + '_data_index' in data_args:
+            index = data_args[mode + '_data_index']
+            store = FeatureStore(feats_path) if os.path.isdir(feats_path) else PickleFeats(feats_path, index)
+            data[mode] = {
+                'feats': LazyFeats(store, index, max_seq_len, ragged, dtype),
+                'lengths': LazyLengths(store, index, max_seq_len)
+            }
     
     return data 
+
+class LazyFeats:
+    '''
+    The padded features of one split, read from the feature store (or the legacy pickle) on access.
+    '''
+    def __init__(self, store, keys, max_seq_len, ragged = False, dtype = 'float32'):
+
+        self.store = store
+        self.keys = keys
+        self.max_seq_len = max_seq_len
+        self.ragged = ragged
+        self.dtype = dtype
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+
+        x_f = np.asarray(self.store[self.keys[index]], dtype = self.dtype)
+        x_f = x_f.squeeze(1) if x_f.ndim == 3 else x_f
+        
+        return x_f[:self.max_seq_len] if self.ragged else padding(x_f, self.max_seq_len)
+
+    def __iter__(self):
+        
+        for index in range(len(self.keys)):
+            yield self[index]
     
-def load_feats(data_args, feats_path):
+class LazyLengths:
+    '''
+    The truncated lengths of one lazy split, read with its features on first access.
+    '''
+    def __init__(self, store, keys, max_seq_len):
+
+        self.store = store
+        self.keys = keys
+        self.max_seq_len = max_seq_len
+        self.lengths = None
+
+    def _load(self):
+
+        if self.lengths is None:
+            self.lengths = [min(l, self.max_seq_len) for l in self.store.get_lengths(self.keys)]
+
+        return self.lengths
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        return self._load()[index]
 
+    def __iter__(self):
+        return iter(self._load())
+
+    def __array__(self, dtype = None, copy = None):
+        return np.asarray(self._load(), dtype = dtype)
+
+def load_feats(data_args, feats_path):
+    '''
+    Only the features of the indexed utterances of the (non-lazy) splits are read.
+    '''
     outputs = {}
 
-    with open(feats_path, 'rb') as f:
-        feats = pickle.load(f)
+    modes = [mode for mode in ['train', 'dev', 'test'] if mode + '_data_index' in data_args and mode not in data_args.get('lazy_modes', [])]
 
-    if 'train_data_index' in data_args:
-        train_feats = [feats[x] for x in data_args['train_data_index']]
-        outputs.update({'train': train_feats})
+    if len(modes) == 0:
+        return outputs
 
-    if 'dev_data_index' in data_args:
-        dev_feats = [feats[x] for x in data_args['dev_data_index']]
-        outputs.update({'dev': dev_feats,})
+    if os.path.isdir(feats_path):
+        store = FeatureStore(feats_path)
+        for mode in modes:
+            outputs[mode] = store.load(data_args[mode + '_data_index'])
 
-    if 'test_data_index' in data_args:
-        test_feats = [feats[x] for x in data_args['test_data_index']]
-        outputs.update({'test': test_feats})
+    else:
+        keys = [x for mode in modes for x in data_args[mode + '_data_index']]
+        feats = load_pickle_feats(feats_path, keys)
+
+        for mode in modes:
+            outputs[mode] = [feats[x] for x in data_args[mode + '_data_index']]
 
     return outputs
 
@@ -124,10 +488,10 @@ def padding(feat, max_length, padding_mode = 'zero', padding_loc = 'end'):
         return feat[:max_length, :]
 
     if padding_mode == 'zero':
-        pad = np.zeros([max_length - length, feat.shape[-1]])
+        pad = np.zeros([max_length - length, feat.shape[-1]], dtype = feat.dtype)
     elif padding_mode == 'normal':
         mean, std = feat.mean(), feat.std()
-        pad = np.random.normal(mean, std, (max_length - length, feat.shape[1]))
+        pad = np.random.normal(mean, std, (max_length - length, feat.shape[1])).astype(feat.dtype)
     
     if padding_loc == 'start':
         feat = np.concatenate((pad, feat), axis = 0)
@@ -136,8 +500,11 @@ def padding(feat, max_length, padding_mode = 'zero', padding_loc = 'end'):
 
     return feat
 
-def padding_feats(feats, max_seq_len):
-
+def padding_feats(feats, max_seq_len, ragged = False, dtype = 'float32'):
+    """
+    ragged: keep the truncated features unpadded, they are padded per batch by mm_collate_fn / dialog_collate_fn
+    dtype: the storage dtype of the features in memory
+    """
     p_feats = {}
 
     for dataset_type in feats.keys():
@@ -147,11 +514,11 @@ def padding_feats(feats, max_seq_len):
         length_list = []
         
         for x in f:
-            x_f = np.array(x) 
+            x_f = np.array(x, dtype = dtype) 
             x_f = x_f.squeeze(1) if x_f.ndim == 3 else x_f
 
             length_list.append(min(len(x_f), max_seq_len))
-            p_feat = padding(x_f, max_seq_len)
+            p_feat = x_f[:max_seq_len] if ragged else padding(x_f, max_seq_len)
             tmp_list.append(p_feat)
 
         p_feats[dataset_type] = {
@@ -161,3 +528,66 @@ def padding_feats(feats, max_seq_len):
 
     return p_feats   
 
+def get_source_files(args):
+    '''
+    The annotation and feature files that the prepared data depends on.
+    '''
+    roots = [os.path.join(args.data_path, args.dataset)]
+    if args.train_ood or args.test_ood:
+        roots.append(os.path.join(args.data_path, args.ood_dataset))
+
+    patterns = ['*.tsv', os.path.join('*', '*.tsv'), os.path.join('*', '*', '*.tsv')]
+    store_patterns = []
+
+    for feats_dir, feats_file in [(args.video_data_path, args.video_feats_path), (args.audio_data_path, args.audio_feats_path)]:
+        for depth in ['', '*', os.path.join('*', '*')]:
+            feats_path = os.path.join(depth, feats_dir, feats_file)
+            patterns.append(feats_path)
+            store_patterns.extend([(os.path.join(get_store_path(feats_path), name), os.path.splitext(feats_file)[1]) for name in [FEATS_FILE, INDEX_FILE]])
+
+    source_files = set()
+    for root in roots:
+        for pattern in patterns:
+            source_files.update(glob.glob(os.path.join(root, pattern)))
+
+        # A store converted from a pickle holds the same features, so converting does not change the fingerprint
+        for pattern, ext in store_patterns:
+            source_files.update([path for path in glob.glob(os.path.join(root, pattern)) if not os.path.exists(os.path.dirname(path) + ext)])
+
+    return sorted(source_files)
+
+def get_data_fingerprint(args, bm):
+
+    fingerprint_keys = ['dataset', 'ood_dataset', 'method', 'dialogue_mode', 'clustering', 'train_ood', 'test_ood', 'aug', 
+                        'text_backbone', 'text_pretrained_model', 'video_feats', 'audio_feats', 'label_len', 'dynamic_padding', 'compact_dataset', 'train', 'feats_dtype']
+
+    infos = {k: args[k] for k in fingerprint_keys if k in args}
+    infos['intent_labels'] = bm['intent_labels']
+    infos['max_seq_lengths'] = bm['max_seq_lengths']
+    infos['source_files'] = [(path, os.path.getmtime(path)) for path in get_source_files(args)]
+
+    return hashlib.md5(json.dumps(infos, sort_keys = True, default = str).encode('utf-8')).hexdigest()
+
+def get_data_cache_file(args, bm):
+
+    fingerprint = get_data_fingerprint(args, bm)
+    return os.path.join(args.data_cache_path, '_'.join([args.dataset, args.method, args.dialogue_mode, fingerprint]) + '.pkl')
+
+def load_data_cache(cache_file):
+
+    with open(cache_file, 'rb') as f:
+        cache = pickle.load(f)
+
+    return cache
+
+def save_data_cache(cache_file, cache):
+
+    cache_dir = os.path.dirname(cache_file)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok = True)
+
+    # Concurrent runs may write the same cache, so write a temporary file and replace atomically
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(cache, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
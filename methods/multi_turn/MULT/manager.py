@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 import logging
 from torch import nn
-from utils.functions import restore_model, save_model, EarlyStopping
+from utils.functions import restore_model, save_model, EarlyStopping, save_checkpoint, load_checkpoint
 from tqdm import trange, tqdm
 from utils.metrics import AverageMeter, Metrics, OOD_Metrics, OID_Metrics
 from data.utils import get_dataloader
@@ -78,7 +78,11 @@ class MULT:
 
         early_stopping = EarlyStopping(args)
 
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+        start_epoch, states = load_checkpoint(args, self.model, self.optimizer, self.scheduler)
+        if states is not None:
+            early_stopping.load_state_dict(states['early_stopping'], self.model)
+
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):
             self.model.train()
             loss_record = AverageMeter()
             
@@ -214,6 +218,8 @@ class MULT:
                 self.logger.info(f'EarlyStopping at epoch {epoch + 1}')
                 break
 
+            save_checkpoint(args, epoch, self.model, self.optimizer, self.scheduler, early_stopping = early_stopping.state_dict())
+
         self.best_eval_score = early_stopping.best_score
         self.model = early_stopping.best_model   
         
@@ -8,7 +8,7 @@ from data.utils import get_dataloader
 from tqdm import tqdm, trange
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from utils.metrics import AverageMeter, Metrics,  OOD_Metrics
-from utils.functions import restore_model, save_model, EarlyStopping
+from utils.functions import restore_model, save_model, EarlyStopping, save_checkpoint, load_checkpoint
 from evaluation.score_func import ood_detection_map
 from torch.utils.data import DataLoader
 from evaluation.oos_cls import doc_classification
@@ -154,7 +154,13 @@ class MMIM(nn.Module):
 
         self.scheduler_main = ReduceLROnPlateau(self.optimizer_main, mode='max', patience=args.wait_patience, factor=0.5, verbose=True)
         
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+        start_epoch, states = load_checkpoint(args, self.model, self.optimizer_main, self.scheduler_main)
+        if states is not None:
+            early_stopping.load_state_dict(states['early_stopping'], self.model)
+            if states['optimizer_mmilb'] is not None:
+                self.optimizer_mmilb.load_state_dict(states['optimizer_mmilb'])
+
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):
 
             if args.contrast:
                 train_loss_mmilb = self._train_mmilb(args)
@@ -182,6 +188,9 @@ class MMIM(nn.Module):
                 self.logger.info(f'EarlyStopping at epoch {epoch + 1}')
                 break
 
+            save_checkpoint(args, epoch, self.model, self.optimizer_main, self.scheduler_main, early_stopping = early_stopping.state_dict(), 
+                            optimizer_mmilb = self.optimizer_mmilb.state_dict() if hasattr(self, 'optimizer_mmilb') else None)
+
         self.best_eval_score = early_stopping.best_score
         self.model = early_stopping.best_model
 
@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional as F
 import logging
 from torch import nn
-from utils.functions import restore_model, save_model, EarlyStopping
+from utils.functions import restore_model, save_model, EarlyStopping, save_checkpoint, load_checkpoint, has_checkpoint
 from tqdm import trange, tqdm
 from utils.metrics import AverageMeter, Metrics
 from transformers import AdamW, get_linear_schedule_with_warmup
@@ -46,7 +46,8 @@ class SDIF:
 
         early_stopping = EarlyStopping(args)
         best_eval_acc = 0.
-        if args.aug:
+        # The augmentation pretraining is part of the restored checkpoint
+        if args.aug and not has_checkpoint(args):
             self.optimizer = AdamW(self.model.parameters(), lr=args.aug_lr, weight_decay=args.aug_weight_decay)
             for epoch in trange(int(args.aug_epoch), desc="Pretrain Epoch"):
                 self.model.train()
@@ -70,7 +71,11 @@ class SDIF:
         self.optimizer = AdamW(self.model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
         self.scheduler = ReduceLROnPlateau(self.optimizer, mode='min', factor=args.factor, verbose=True, patience=args.opt_patience)
 
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+        start_epoch, states = load_checkpoint(args, self.model, self.optimizer, self.scheduler)
+        if states is not None:
+            early_stopping.load_state_dict(states['early_stopping'], self.model)
+
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):
             self.model.train()
             loss_record = AverageMeter()
             
@@ -132,6 +137,8 @@ class SDIF:
                 self.logger.info(f'EarlyStopping at epoch {epoch + 1}')
                 break
 
+            save_checkpoint(args, epoch, self.model, self.optimizer, self.scheduler, early_stopping = early_stopping.state_dict())
+
         self.best_eval_score = early_stopping.best_score
         self.model = early_stopping.best_model   
         
@@ -3,9 +3,10 @@ import logging
 from utils.metrics import CLUSTERING_Metrics
 # from backbones.base import freeze_bert_parameters
 from tqdm import trange, tqdm
-from sklearn.cluster import KMeans
+from utils.kmeans import get_kmeans
 from data.utils import get_dataloader
-from utils.functions import save_model, restore_model
+from backbones.SubNets.FeatureNets import cache_frozen_text_states
+from utils.functions import save_model, restore_model, save_checkpoint, load_checkpoint
 from .utils import _set_optimizer, get_augment_dataloader
 from utils.loss import InstanceLoss,ClusterLoss
 
@@ -74,8 +75,11 @@ class CCManager:
     def _train(self, args):
          
         self.logger.info('CC training starts...')
+        cache_frozen_text_states(self.model, [self.augdataloader, self.test_dataloader])
+
+        start_epoch, _ = load_checkpoint(args, self.model, self.optimizer, self.scheduler)
         
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):  
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):  
 
             tr_loss, nb_tr_steps = 0, 0
             self.model.train()
@@ -87,8 +91,7 @@ class CCManager:
                                            
                 with torch.set_grad_enabled(True):
                     
-                    x_i = self.model(text_feats, video_feats, audio_feats)
-                    x_j = self.model(text_feats, video_feats, audio_feats)
+                    x_i, x_j = self.model.forward_views(2, text_feats, video_feats, audio_feats)
                 
                     z_i, z_j, c_i, c_j = self.model.model.get_features(x_i, x_j)
                     loss_instance = self.criterion_instance(z_i, z_j)
@@ -108,6 +111,8 @@ class CCManager:
             
             self.logger.info("***** Epoch: %s: train results *****", str(epoch))
             self.logger.info("  train_loss = %s",  str(train_loss))
+
+            save_checkpoint(args, epoch, self.model, self.optimizer, self.scheduler)
         
         self.logger.info('CC training finished...')
         if args.save_model:
@@ -118,7 +123,7 @@ class CCManager:
         outputs = self._get_outputs(args, mode = 'test')
         feats, y_true = outputs['feats'], outputs['y_true']
 
-        km = KMeans(n_clusters = self.num_labels,  random_state=args.seed).fit(feats)
+        km = get_kmeans(args, self.num_labels).fit(feats)
         y_pred = km.labels_
         
         test_results = self.clustering_metrics(y_true, y_pred)
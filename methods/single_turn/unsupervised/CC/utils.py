@@ -2,6 +2,7 @@ import torch
 from torch import optim
 from torch.utils.data import DataLoader, RandomSampler, Dataset
 import numpy as np
+from data.utils import pad_feats
 from transformers import AdamW, get_linear_schedule_with_warmup
 
 def get_augment_dataloader(args, train_outputs):
@@ -39,9 +40,9 @@ class MMPseudoDataset(Dataset):
         
     def __init__(self, text_feats, video_data, audio_data):
         
-        self.text_feats = torch.tensor(text_feats)
-        self.video_feats = torch.tensor(np.array(video_data['feats']))
-        self.audio_feats = torch.tensor(np.array(audio_data['feats']))
+        self.text_feats = torch.as_tensor(text_feats, dtype = torch.long)
+        self.video_feats = pad_feats(video_data['feats'])
+        self.audio_feats = pad_feats(audio_data['feats'])
         self.size = len(self.text_feats)
 
     def __len__(self):
@@ -51,7 +52,7 @@ class MMPseudoDataset(Dataset):
 
         sample = { 
             'text_feats': self.text_feats[index],
-            'video_feats': self.video_feats[index],
-            'audio_feats': self.audio_feats[index],
+            'video_feats': self.video_feats[index].float(),
+            'audio_feats': self.audio_feats[index].float(),
         } 
         return sample
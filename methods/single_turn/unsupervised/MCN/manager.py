@@ -1,11 +1,12 @@
 import torch
 import logging
 import time
-from sklearn.cluster import KMeans
+from utils.kmeans import get_kmeans
 from tqdm import trange, tqdm
-from utils.functions import restore_model, save_model
+from backbones.SubNets.FeatureNets import cache_frozen_text_states
+from utils.functions import restore_model, save_model, save_checkpoint, load_checkpoint, FeatureBank
 from utils.metrics import CLUSTERING_Metrics
-from data.utils import get_dataloader
+from data.utils import get_dataloader, get_subset_dataloader
 from .utils import MMS_loss, _set_optimizer, get_pseudo_dataloader
 
 __all__ = ['MCN']
@@ -46,14 +47,14 @@ class MCNManager:
 
     def clustering(self, args):
         
-        feats, y_true = self._get_outputs(args, mode = 'train')
+        feats = self._get_train_feats(args)
     
         start = time.time()
         self.logger.info('start kmeans...')
         if self.centroids is None:
-            km = KMeans(n_clusters = self.num_labels,  random_state=args.seed, init = 'k-means++').fit(feats) 
+            km = get_kmeans(args, self.num_labels, init = 'k-means++').fit(feats) 
         else:
-            km = KMeans(n_clusters = self.num_labels,  random_state=args.seed, init = self.centroids.cpu().numpy()).fit(feats)
+            km = get_kmeans(args, self.num_labels, init = self.centroids).fit(feats)
         end = time.time() 
         self.logger.info('K-means used %s s', round(end-start, 2))
 
@@ -62,12 +63,34 @@ class MCNManager:
 
         return assign_labels
 
+    def _get_train_feats(self, args):
+        '''
+        The features of the training samples for clustering. With --reuse_train_feats, the features captured in the last training pass are reused,
+        and only the samples missing from it are encoded.
+        '''
+        if self.feats_bank is None:
+            return self._get_outputs(args, mode = 'train')[0]
+
+        stale_ids = self.feats_bank.stale_ids()
+        if len(stale_ids) > 0:
+            dataloader = get_subset_dataloader(args, self.train_dataloader.dataset, stale_ids, args.train_batch_size)
+            feats, _ = self._get_outputs(args, mode = 'train', dataloader = dataloader)
+            self.feats_bank.update(stale_ids, torch.from_numpy(feats))
+
+        return self.feats_bank.get_feats()
+
     def _train(self, args): 
 
         self.centroids = None
+        self.feats_bank = FeatureBank(len(self.train_dataloader.dataset)) if args.reuse_train_feats else None
         self.mms_loss = MMS_loss().to(self.device)
+        cache_frozen_text_states(self.model, [self.train_dataloader, self.test_dataloader])
 
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+        start_epoch, states = load_checkpoint(args, self.model, self.optimizer, self.scheduler)
+        if states is not None:
+            self.centroids = states['centroids'].to(self.device)
+
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):
 
             tot_loss, tot_loss_mms, tot_loss_clu, tot_loss_recon, cnt = 0, 0, 0, 0, 0
             assigned_labels = self.clustering(args)
@@ -85,6 +108,9 @@ class MCNManager:
                 else:
                     text, video, audio = self.model(text_feats, video_feats, audio_feats, mode='train')
 
+                if self.feats_bank is not None:
+                    self.feats_bank.update(batch['sample_ids'], (text + video + audio) / 3)
+
                 with torch.set_grad_enabled(True):
                     loss_mms = self._get_loss_mms(text, video, audio)
                     loss_clu = self._get_loss_cluster(text, video, audio, label_ids)
@@ -120,16 +146,16 @@ class MCNManager:
             if (epoch+1) % 50 == 0:
                 self._test(args)
 
+            save_checkpoint(args, epoch, self.model, self.optimizer, self.scheduler, centroids = self.centroids.cpu())
+
         if args.save_model:
             self.logger.info('Trained models are saved in %s', args.model_output_path)
             save_model(self.model, args.model_output_path)  
    
-    def _get_outputs(self, args, mode):
+    def _get_outputs(self, args, mode, dataloader = None):
         
-        if mode == 'test':
-            dataloader = self.test_dataloader
-        elif mode == 'train':
-            dataloader = self.train_dataloader
+        if dataloader is None:
+            dataloader = self.test_dataloader if mode == 'test' else self.train_dataloader
 
         self.model.eval()
 
@@ -159,8 +185,7 @@ class MCNManager:
         self.model.to(self.device)
         feats, y_true = self._get_outputs(args, mode = 'test')
 
-        km = KMeans(n_clusters = self.num_labels, random_state=args.seed, \
-                    init = self.centroids.cpu().numpy() if self.centroids is not None else 'k-means++').fit(feats) 
+        km = get_kmeans(args, self.num_labels, init = self.centroids if self.centroids is not None else 'k-means++').fit(feats) 
        
         y_pred = km.labels_
         
@@ -7,6 +7,7 @@ from torch import optim
 import math
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
+from data.utils import pad_feats
 
 def _set_optimizer(args, model):
 
@@ -48,10 +49,11 @@ class MMPseudoDataset(Dataset):
     def __init__(self, label_ids, text_feats, video_data, audio_data):
         
         self.label_ids = torch.tensor(label_ids)
-        self.text_feats = torch.tensor(text_feats)
-        self.video_feats = torch.tensor(np.array(video_data['feats']))
-        self.audio_feats = torch.tensor(np.array(audio_data['feats']))
+        self.text_feats = torch.as_tensor(text_feats, dtype = torch.long)
+        self.video_feats = pad_feats(video_data['feats'])
+        self.audio_feats = pad_feats(audio_data['feats'])
         self.size = len(self.text_feats)
+        self.sample_ids = torch.arange(self.size)
 
     def __len__(self):
         return self.size
@@ -61,8 +63,9 @@ class MMPseudoDataset(Dataset):
         sample = {
             'label_ids': self.label_ids[index], 
             'text_feats': self.text_feats[index],
-            'video_feats': self.video_feats[index],
-            'audio_feats': self.audio_feats[index],
+            'video_feats': self.video_feats[index].float(),
+            'audio_feats': self.audio_feats[index].float(),
+            'sample_ids': self.sample_ids[index],
         } 
         return sample
 
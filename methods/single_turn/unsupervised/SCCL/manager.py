@@ -6,12 +6,13 @@ import torch.nn as nn
 
 from sklearn.metrics import confusion_matrix
 from tqdm import trange, tqdm
-from sklearn.cluster import KMeans 
+from utils.kmeans import get_kmeans
 from utils.metrics import CLUSTERING_Metrics
 from utils.functions import save_model
 from data.utils import get_dataloader
 from .utils import _set_optimizer, target_distribution, get_augment_dataloader, PairConLoss
-from utils.functions import restore_model, save_model, EarlyStopping
+from backbones.SubNets.FeatureNets import cache_frozen_text_states
+from utils.functions import restore_model, save_model, EarlyStopping, save_checkpoint, load_checkpoint
 
 class SCCLManager:
     
@@ -48,8 +49,11 @@ class SCCLManager:
     def _train(self, args):
         
         self.logger.info('SCCL training starts...')
+        cache_frozen_text_states(self.model, [self.augdataloader, self.test_dataloader])
+
+        start_epoch, _ = load_checkpoint(args, self.model, self.optimizer)
         
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):  
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):  
             self.model.train()
             tr_loss, nb_tr_steps = 0, 0
             for batch in tqdm(self.augdataloader, desc="Training(All)"):
@@ -59,13 +63,7 @@ class SCCLManager:
                     video_feats = batch['video_feats'].to(self.device)
                     audio_feats = batch['audio_feats'].to(self.device)
 
-                    embd1 = self.model(text_feats, video_feats, audio_feats)
-                    # loss_model_1 = self.model.get_model_loss(args.multimodal_method)
-                    embd2 = self.model(text_feats, video_feats, audio_feats)
-                    # loss_model_2 = self.model.get_model_loss(args.multimodal_method)
-                    embd3 = self.model(text_feats, video_feats, audio_feats)
-                    # loss_model_3 = self.model.get_model_loss(args.multimodal_method)
-                    # loss_model = (loss_model_1 + loss_model_2 + loss_model_3) / 3 
+                    embd1, embd2, embd3 = self.model.forward_views(3, text_feats, video_feats, audio_feats)
                     # Instance-CL loss
 
                     feat1, feat2 = self.model.model.contrast_logits(embd2, embd3)
@@ -88,6 +86,8 @@ class SCCLManager:
             self.logger.info("***** Epoch: %s: train results *****", str(epoch))
             self.logger.info("  train_loss = %s",  str(train_loss))
 
+            save_checkpoint(args, epoch, self.model, self.optimizer)
+
         self.logger.info('SCCL training finished...')
 
         if args.save_model:
@@ -99,7 +99,7 @@ class SCCLManager:
         outputs = self._get_outputs(args, mode = 'test')
         feats, y_true = outputs['feats'], outputs['y_true']
 
-        km = KMeans(n_clusters = self.num_labels, random_state=args.seed).fit(feats)
+        km = get_kmeans(args, self.num_labels).fit(feats)
         y_pred = km.labels_
         
         test_results = self.clustering_metrics(y_true, y_pred)
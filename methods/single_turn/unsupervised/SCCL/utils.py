@@ -2,7 +2,8 @@ import torch
 from torch import nn
 from torch.utils.data import DataLoader, RandomSampler, Dataset
 import numpy as np
-from sklearn.cluster import KMeans
+from data.utils import pad_feats
+from utils.kmeans import get_kmeans
 from tqdm import tqdm
 
 def _set_optimizer(args, model, train_dataloader):
@@ -35,7 +36,7 @@ def get_kmeans_centers(train_loader, args, model):
             all_embeddings = np.concatenate((all_embeddings, corpus_embeddings.cpu().detach().numpy()), axis=0)
 
     print('embedding shape', all_embeddings.shape)
-    clustering_model = KMeans(n_clusters=args.num_labels, random_state=args.seed)
+    clustering_model = get_kmeans(args, args.num_labels)
     clustering_model.fit(all_embeddings)
 
     print("Iterations:{},  centers:{}".format(clustering_model.n_iter_,   clustering_model.cluster_centers_.shape))
@@ -55,9 +56,9 @@ class MMPseudoDataset(Dataset):
         
     def __init__(self, text_feats, video_data, audio_data):
         
-        self.text_feats = torch.tensor(text_feats)
-        self.video_feats = torch.tensor(np.array(video_data['feats']))
-        self.audio_feats = torch.tensor(np.array(audio_data['feats']))
+        self.text_feats = torch.as_tensor(text_feats, dtype = torch.long)
+        self.video_feats = pad_feats(video_data['feats'])
+        self.audio_feats = pad_feats(audio_data['feats'])
         self.size = len(self.text_feats)
 
     def __len__(self):
@@ -67,8 +68,8 @@ class MMPseudoDataset(Dataset):
 
         sample = { 
             'text_feats': self.text_feats[index],
-            'video_feats': self.video_feats[index],
-            'audio_feats': self.audio_feats[index],
+            'video_feats': self.video_feats[index].float(),
+            'audio_feats': self.audio_feats[index].float(),
         } 
         return sample
 
@@ -7,21 +7,21 @@ import os
 import time 
 import copy
 
-from sklearn.cluster import KMeans
+from utils.kmeans import get_kmeans
 from tqdm import trange, tqdm
 from utils.loss import SupConLoss
-from utils.functions import save_model, restore_model, set_torch_seed
+from utils.functions import save_model, restore_model, set_torch_seed, save_checkpoint, load_checkpoint, FeatureBank
 from transformers import BertTokenizer
 
 from backbones.base import freeze_bert_parameters
-from sklearn.neighbors import NearestNeighbors, KDTree
+from backbones.SubNets.FeatureNets import cache_frozen_text_states
 # from utils.neighbor_dataset import NeighborsDataset
 from torch.utils.data import DataLoader
 
 from utils.metrics import CLUSTERING_Metrics
 from .pretrain import PretrainUMCManager
 
-from data.utils import get_dataloader
+from data.utils import get_dataloader, get_subset_dataloader
 from .utils import *
 
 class UMCManager:
@@ -70,15 +70,13 @@ class UMCManager:
 
     def clustering(self, args, init = 'k-means++', threshold = 0.25):
         
-        outputs = self._get_outputs(args, mode = 'train', return_feats = True)
-        feats = outputs['feats']
-        y_true = outputs['y_true']
+        feats = self._get_train_feats(args)
         
         if init == 'k-means++':
             
             self.logger.info('Initializing centroids with K-means++...')
             start = time.time()
-            km = KMeans(n_clusters = self.num_labels, random_state=args.seed, init = 'k-means++').fit(feats) 
+            km = get_kmeans(args, self.num_labels, init = 'k-means++').fit(feats) 
             
             km_centroids, assign_labels = km.cluster_centers_, km.labels_
             end = time.time()
@@ -87,7 +85,7 @@ class UMCManager:
         elif init == 'centers':
             
             start = time.time()
-            km = KMeans(n_clusters = self.num_labels, random_state=args.seed, init = self.centroids).fit(feats)
+            km = get_kmeans(args, self.num_labels, init = self.centroids).fit(feats)
             km_centroids, assign_labels = km.cluster_centers_, km.labels_ 
             end = time.time()
             self.logger.info('K-means used %s s', round(end - start, 2))
@@ -107,47 +105,41 @@ class UMCManager:
                 select_ids.extend(pos)
 
             else:
-                
-                best_sorted_indices = None
-                best_eval_score = 1000000
-
-                for k_cand in k_candidate_proportions:
-
-                    k = max(int(len(cluster_samples) * k_cand), 1)
-                    nbrs = NearestNeighbors(n_neighbors=k+1, algorithm='auto').fit(cluster_samples)
-                    distances, indices = nbrs.kneighbors(cluster_samples)
-                    
-                    reachable_distances = np.mean(distances[:, 1:], axis=1) 
-                    density = 1 / reachable_distances  
-                    sorted_indices = np.argsort(density)
-
-                    tmp_select_indices = sorted_indices[-cutoff:]
-                    tmp_select_pos = [pos[i] for i in tmp_select_indices] 
-                    
-                    tmp_feats = feats[tmp_select_pos]
-                    
-                    tree = KDTree(tmp_feats)
-                    _, ind = tree.query(tmp_feats, k=2)  
-                    nearest_neighbor_distances = np.array([tmp_feats[i] - tmp_feats[ind[i, 1]] for i in range(len(tmp_feats))])
-                    tmp_eval_score = np.mean(np.linalg.norm(nearest_neighbor_distances, axis=1))
-
-                    if tmp_eval_score < best_eval_score:
-               
-                        best_eval_score = tmp_eval_score
-                        best_sorted_indices = sorted_indices
-
-                select_indices = best_sorted_indices[-cutoff:]
+                select_indices = select_dense_samples(cluster_samples, cutoff, k_candidate_proportions)
                 select_pos = [pos[i] for i in select_indices] 
                 select_ids.extend(select_pos)
         
 
         return np.array(assign_labels), select_ids, feats
+
+    def _get_train_feats(self, args):
+        '''
+        The features of the training samples for clustering. With --reuse_train_feats, the features captured in the last training pass are reused,
+        and only the samples missing from it are encoded.
+        '''
+        if self.feats_bank is None:
+            return self._get_outputs(args, mode = 'train', return_feats = True)['feats']
+
+        stale_ids = self.feats_bank.stale_ids()
+        if len(stale_ids) > 0:
+            dataloader = get_subset_dataloader(args, self.train_dataloader.dataset, stale_ids, args.train_batch_size)
+            outputs = self._get_outputs(args, mode = 'train', return_feats = True, dataloader = dataloader)
+            self.feats_bank.update(stale_ids, torch.from_numpy(outputs['feats']))
+
+        return self.feats_bank.get_feats()
                   
     def _train(self, args): 
         
         self.model.to(self.device)
+        self.feats_bank = FeatureBank(len(self.train_dataloader.dataset)) if args.reuse_train_feats else None
+        cache_frozen_text_states(self.model, [self.train_dataloader, self.test_dataloader])
+
+        start_epoch, states = load_checkpoint(args, self.model, self.optimizer, self.scheduler)
+        if states is not None:
+            self.centroids, non_select_ids = states['centroids'], states['non_select_ids']
+            tr_sup_loss, tr_unsup_loss = states['tr_sup_loss'], states['tr_unsup_loss']
         
-        for epoch in trange(int(args.num_train_epochs), desc='Epoch'):
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc='Epoch'):
 
             threshold = args.thres + args.delta * epoch
 
@@ -160,11 +152,7 @@ class UMCManager:
                 if len(non_select_ids) != 0:
                     self.logger.info('Unsupervised Training Loss: %f', np.round(tr_unsup_loss, 5))
 
-            self.train_outputs['label_ids'] = pseudo_labels
-            self.train_outputs['select_ids'] = select_ids
-            
-            _, pseudo_sup_train_dataloader = get_pseudo_dataloader(args=args, \
-                train_outputs=self.train_outputs, mode='pretrain')
+            _, pseudo_sup_train_dataloader = get_pseudo_dataloader(args, self.train_dataloader.dataset, pseudo_labels, select_ids, mode='pretrain')
             
             
             self.model.train()
@@ -183,9 +171,9 @@ class UMCManager:
 
                 with torch.set_grad_enabled(True):
 
-                    _, mlp_output_a = self.model(text_feats, torch.zeros_like(video_feats).to(self.device), audio_feats, mode='train-mm')
-                    _, mlp_output_b = self.model(text_feats, video_feats, torch.zeros_like(audio_feats).to(self.device), mode='train-mm')
-                    _, mlp_output_c = self.model(text_feats, video_feats, audio_feats, mode='train-mm')
+                    features, (mlp_output_a, mlp_output_b, mlp_output_c) = self.model(text_feats, video_feats, audio_feats, mode='views')
+                    if self.feats_bank is not None:
+                        self.feats_bank.update(batch_sup['sample_ids'], features)
 
                     norm_mlp_output_a = F.normalize(mlp_output_a)
                     norm_mlp_output_b = F.normalize(mlp_output_b)
@@ -214,13 +202,13 @@ class UMCManager:
 
             tr_sup_loss /= nb_tr_steps
 
-            non_select_ids = [i for i in range(len(pseudo_labels)) if i not in select_ids]
+            non_select_mask = np.ones(len(pseudo_labels), dtype = bool)
+            non_select_mask[select_ids] = False
+            non_select_ids = np.where(non_select_mask)[0].tolist()
             
             if len(non_select_ids) != 0:
 
-                self.train_outputs['select_ids'] = non_select_ids
-                _, pseudo_unsup_train_dataloader = get_pseudo_dataloader(args=args, \
-                    train_outputs=self.train_outputs, mode='pretrain')
+                _, pseudo_unsup_train_dataloader = get_pseudo_dataloader(args, self.train_dataloader.dataset, pseudo_labels, non_select_ids, mode='pretrain')
 
                 tr_unsup_loss = 0
                 nb_tr_examples, nb_tr_steps = 0, 0
@@ -233,9 +221,9 @@ class UMCManager:
 
                     with torch.set_grad_enabled(True):
     
-                        _, mlp_output_a = self.model(unsup_text_feats, torch.zeros_like(unsup_video_feats).to(self.device), unsup_audio_feats, mode='train-mm')
-                        _, mlp_output_b = self.model(unsup_text_feats, unsup_video_feats, torch.zeros_like(unsup_audio_feats).to(self.device), mode='train-mm')
-                        _, mlp_output_c = self.model(unsup_text_feats, unsup_video_feats, unsup_audio_feats, mode='train-mm')
+                        features, (mlp_output_a, mlp_output_b, mlp_output_c) = self.model(unsup_text_feats, unsup_video_feats, unsup_audio_feats, mode='views')
+                        if self.feats_bank is not None:
+                            self.feats_bank.update(batch_unsup['sample_ids'], features)
 
                         norm_mlp_output_a = F.normalize(mlp_output_a)
                         norm_mlp_output_b = F.normalize(mlp_output_b)
@@ -263,6 +251,9 @@ class UMCManager:
                 
                 tr_unsup_loss /= nb_tr_steps
 
+            save_checkpoint(args, epoch, self.model, self.optimizer, self.scheduler, centroids = self.centroids, non_select_ids = non_select_ids, 
+                            tr_sup_loss = tr_sup_loss, tr_unsup_loss = tr_unsup_loss if len(non_select_ids) != 0 else None)
+
         if args.save_model:
             save_model(self.model, args.model_output_path)
 
@@ -274,8 +265,7 @@ class UMCManager:
         feats = outputs['feats']
         y_true = outputs['y_true']
 
-        km = KMeans(n_clusters = self.num_labels, random_state=args.seed, \
-                    init = 'k-means++').fit(feats) 
+        km = get_kmeans(args, self.num_labels, init = 'k-means++').fit(feats) 
        
         y_pred = km.labels_
         
@@ -291,13 +281,10 @@ class UMCManager:
 
         return test_results
 
-    def _get_outputs(self, args, mode, return_feats = False, modality = 'tva'):
+    def _get_outputs(self, args, mode, return_feats = False, modality = 'tva', dataloader = None):
         
-        if mode == 'test':
-   
-            dataloader = self.test_dataloader
-        elif mode == 'train':
-            dataloader = self.train_dataloader
+        if dataloader is None:
+            dataloader = self.test_dataloader if mode == 'test' else self.train_dataloader
 
         self.model.eval()
 
@@ -6,10 +6,14 @@ import logging
 from tqdm import trange, tqdm
 from transformers import BertTokenizer
 from utils.loss import SupConLoss
-from utils.functions import save_model, restore_model
+from utils.functions import save_model, restore_model, file_lock, get_pretrain_cache_dir, load_pretrain_cache, save_pretrain_cache
 from .utils import * #set_optimizer, view_generator, get_pseudo_dataloader
 
 from backbones.base import freeze_bert_parameters
+from backbones.SubNets.FeatureNets import cache_frozen_text_states
+
+# The hyper-parameters that are only used after pretraining
+FINETUNE_KEYS = ['lr', 'train_temperature_sup', 'train_temperature_unsup', 'delta', 'thres', 'topk', 'eval_batch_size', 'test_batch_size']
 
 class PretrainUMCManager:
     
@@ -25,6 +29,7 @@ class PretrainUMCManager:
         #     self.model = freeze_bert_parameters(self.model, args.multimodal_method)
 
         self.train_outputs = data.train_outputs
+        self.train_data = data.data['train']
 
         
         
@@ -34,10 +39,27 @@ class PretrainUMCManager:
         self.generator = view_generator(self.tokenizer, args)
 
         if args.pretrain:
-            
-            self.logger.info('Pre-training start...')
-            self._train(args)
-            self.logger.info('Pre-training finished...')
+
+            # The grid points that only differ in the fine-tuning hyper-parameters share one pretrained model
+            cache_dir = get_pretrain_cache_dir(args, data.fingerprint, FINETUNE_KEYS)
+            if not os.path.exists(os.path.dirname(cache_dir)):
+                os.makedirs(os.path.dirname(cache_dir), exist_ok = True)
+
+            # Parallel jobs wait for the one pretraining the same model
+            with file_lock(cache_dir + '.lock'):
+                if load_pretrain_cache(cache_dir, self.model):
+                    self.logger.info('Pre-trained model is loaded from %s', cache_dir)
+                else:
+                    self.logger.info('Pre-training start...')
+                    self._train(args)
+                    self.logger.info('Pre-training finished...')
+                    save_pretrain_cache(cache_dir, self.model)
+
+            if args.save_model:
+                pretrained_model_dir = os.path.join(args.model_output_path, 'pretrain')
+                if not os.path.exists(pretrained_model_dir):
+                    os.makedirs(pretrained_model_dir)
+                save_model(self.model, pretrained_model_dir)
             
         else:
             self.model = restore_model(self.model, os.path.join(args.model_output_path, 'pretrain'), self.device)
@@ -47,7 +69,8 @@ class PretrainUMCManager:
         
     def _train(self, args):
         
-        pseudo_data, pseudo_dataloader = get_pseudo_dataloader(args, self.train_outputs, mode='pretrain')
+        pseudo_data, pseudo_dataloader = get_pseudo_dataloader(args, self.train_data, self.train_outputs['label_ids'], mode='pretrain')
+        cache_frozen_text_states(self.model, [pseudo_dataloader])
 
         for epoch in trange(int(args.num_pretrain_epochs), desc="Epoch"):
             
@@ -63,9 +86,7 @@ class PretrainUMCManager:
                 
                 with torch.set_grad_enabled(True):
 
-                    mlp_output_a = self.model(text_feats, torch.zeros_like(video_feats).to(self.device), audio_feats, mode='pretrain-mm')
-                    mlp_output_b = self.model(text_feats, video_feats, torch.zeros_like(audio_feats).to(self.device), mode='pretrain-mm')
-                    mlp_output_c = self.model(text_feats, video_feats, audio_feats, mode='pretrain-mm')
+                    _, (mlp_output_a, mlp_output_b, mlp_output_c) = self.model(text_feats, video_feats, audio_feats, mode='views')
 
                     norm_mlp_output_a = F.normalize(mlp_output_a)
                     norm_mlp_output_b = F.normalize(mlp_output_b)
@@ -93,9 +114,3 @@ class PretrainUMCManager:
             self.logger.info("***** Epoch: %s: Eval results *****", str(epoch + 1))
             for key in sorted(eval_results.keys()):
                 self.logger.info("  %s = %s", key, str(eval_results[key]))
-
-        if args.save_model:
-            pretrained_model_dir = os.path.join(args.model_output_path, 'pretrain')
-            if not os.path.exists(pretrained_model_dir):
-                os.makedirs(pretrained_model_dir)
-            save_model(self.model, pretrained_model_dir)
@@ -1,108 +1,85 @@
 import torch
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader, RandomSampler,SequentialSampler
-from data.mm_pre import MMDataset
+from data.mm_pre import PseudoLabelDataset
+from data.utils import get_collate_fn, get_batch_sampler, build_dataloader, random_token_erase, random_frame_erase
 import numpy as np
 import torch.nn.functional as F
+from sklearn.neighbors import NearestNeighbors, KDTree
 from transformers import AdamW, get_linear_schedule_with_warmup
 
-def get_pseudo_dataloader(args, train_outputs, mode='pretrain', pseudo_labels=None):
-    
+def get_pseudo_dataloader(args, dataset, pseudo_labels, select_ids = None, mode = 'pretrain'):
     '''
-    video_data: {'feats': xxx, 'lengths': xxx}
-    audio_data: {'feats': xxx, 'lengths': xxx}
-    text_data: [input_ids, input_mask, segment_ids]
+    The samples of select_ids (all if None) of the training dataset with their pseudo labels. 
+    The dataset is viewed through the indices, so the features are not copied.
     '''
-    text = train_outputs['text']
-    video = train_outputs['video']
-    audio = train_outputs['audio'] 
+    train_label_ids = torch.as_tensor(np.asarray(pseudo_labels), dtype = torch.long).unsqueeze(1)
+    train_data = PseudoLabelDataset(dataset, train_label_ids, indices = select_ids)
 
-    if 'select_ids' in train_outputs.keys():
-        select_ids = train_outputs['select_ids']    
-                                           
-    if pseudo_labels is None:
-        pseudo_labels = train_outputs['label_ids']
+    batch_size = args.pretrain_batch_size if mode == 'pretrain' else args.train_batch_size
 
-    if 'select_ids' in train_outputs.keys():
+    if args.length_bucketing:
+        train_dataloader = build_dataloader(train_data, batch_sampler = get_batch_sampler(args, train_data, batch_size), collate_fn = get_collate_fn(args))
+    else:
+        train_dataloader = build_dataloader(train_data, shuffle = True, batch_size = batch_size, collate_fn = get_collate_fn(args))
 
-        pseudo_labels = pseudo_labels[select_ids]
-        text = [text[i] for i in select_ids]
-        new_video = {}
+                                      
+    return train_data, train_dataloader
 
-        new_video['lengths'] = [video['lengths'][i] for i in select_ids]
-        new_video['feats'] = [video['feats'][i] for i in select_ids]
+def select_dense_samples(feats, cutoff, k_candidate_proportions):
+    '''
+    The indices of the cutoff densest samples of a cluster. The density of a sample is the inverse of its mean distance to its k nearest neighbors,
+    and k is the candidate whose selected samples are the closest to each other (the least mean nearest neighbor distance).
 
-        new_audio = {}
-        new_audio['lengths'] = [audio['lengths'][i] for i in select_ids]
-        new_audio['feats'] = [audio['feats'][i] for i in select_ids]
+    The neighbors are queried once at the largest candidate k, and the distances of the smaller k are the first columns of the sorted distances.
+    '''
+    ks = [max(int(len(feats) * k_cand), 1) for k_cand in k_candidate_proportions]
 
-        train_label_ids = torch.tensor(pseudo_labels).unsqueeze(1)
-        train_data = MMDataset(train_label_ids, text, new_video, new_audio)
+    nbrs = NearestNeighbors(n_neighbors = max(ks) + 1, algorithm = 'auto').fit(feats)
+    distances, _ = nbrs.kneighbors(feats)
 
-    else:
-        train_label_ids = torch.tensor(pseudo_labels).unsqueeze(1)
-        train_data = MMDataset(train_label_ids, text, video, audio)
+    best_sorted_indices = None
+    best_eval_score = 1000000
+    eval_scores = {}
 
+    for k in ks:
 
+        reachable_distances = np.mean(distances[:, 1: k + 1], axis = 1)
+        density = 1 / reachable_distances
+        sorted_indices = np.argsort(density)
 
-    sampler = RandomSampler(train_data)
+        # Different k often select the same samples, which are scored only once
+        select_indices = sorted_indices[-cutoff:]
+        select_key = np.sort(select_indices).tobytes()
 
-    if mode == 'pretrain':
-        train_dataloader = DataLoader(train_data, sampler = sampler, batch_size = args.pretrain_batch_size)
-    else:
-        train_dataloader = DataLoader(train_data, sampler = sampler, batch_size = args.train_batch_size)
+        if select_key not in eval_scores:
+            select_feats = feats[select_indices]
+            nn_distances, _ = KDTree(select_feats).query(select_feats, k = 2)
+            eval_scores[select_key] = np.mean(nn_distances[:, 1])
 
-                                      
-    return train_data, train_dataloader
+        if eval_scores[select_key] < best_eval_score:
+            best_eval_score = eval_scores[select_key]
+            best_sorted_indices = sorted_indices
+
+    return best_sorted_indices[-cutoff:]
 
 class view_generator:
     
     def __init__(self, tokenizer, args):
         self.tokenizer = tokenizer
         self.args = args
+        self.special_ids = torch.tensor(tokenizer.all_special_ids)
     
     def random_token_erase(self, input_x, input_mask, max_seq_length=30, mode = 'text'):
-        
-        aug_input_x = []
-        aug_input_mask = []
-
-        for inp_x, inp_m in zip(input_x, input_mask):
-            
-            if mode == 'text':
-                special_tokens_mask = self.tokenizer.get_special_tokens_mask(inp_x, already_has_special_tokens=True)
-                sent_tokens_inds = np.where(np.array(special_tokens_mask) == 0)[0]
-
-                inds = np.arange(len(sent_tokens_inds))
-                masked_inds = np.random.choice(inds, size = int(len(inds) * self.args.re_prob), replace = False)
-                sent_masked_inds = sent_tokens_inds[masked_inds]
-
-                inp_x = np.delete(inp_x, sent_masked_inds)
-                inp_x = F.pad(inp_x, (0, max_seq_length - len(inp_x)), mode = 'constant', value = 0)
+        '''
+        Erases random tokens of the texts (mode = 'text') or a random span of frames of the videos / audios, for the whole batch at once.
+        '''
+        input_x, input_mask = torch.as_tensor(input_x), torch.as_tensor(input_mask)
 
-                inp_m = np.delete(inp_m, sent_masked_inds)
-                inp_m = F.pad(inp_m, (0, max_seq_length - len(inp_m)), 'constant', 0)
-            
-            else:
-                sent_tokens_inds = np.where(inp_m.numpy() == 1)[0]
-
-                erase_start_ind = np.random.choice(sent_tokens_inds)
-                erase_end_ind = min(erase_start_ind + max(1, int(self.args.re_prob * (len(sent_tokens_inds) - erase_start_ind))), len(sent_tokens_inds))
-                erase_inds = sent_tokens_inds[erase_start_ind: erase_end_ind]
-
-                inp_x = np.delete(inp_x, erase_inds, axis = 0)
-                inp_x = torch.from_numpy(inp_x)
-                inp_x = F.pad(inp_x, (0, 0, 0, max_seq_length - len(inp_x)), mode = 'constant', value = 0)
-
-                inp_m = np.delete(inp_m, erase_inds)
-                inp_m = F.pad(inp_m, (0, max_seq_length - len(inp_m)), 'constant', 0)
-
-            aug_input_x.append(inp_x)
-            aug_input_mask.append(inp_m)
-        
-        aug_input_x = torch.stack(aug_input_x, dim = 0)
-        aug_input_mask = torch.stack(aug_input_mask, dim = 0)
+        if mode == 'text':
+            return random_token_erase(input_x, input_mask, self.special_ids, self.args.re_prob, max_seq_length)
 
-        return aug_input_x, aug_input_mask
+        return random_frame_erase(input_x, input_mask, self.args.re_prob, max_seq_length)
 
         
 def set_optimizer(args, model, lr, mode='train'):
@@ -7,11 +7,12 @@ import os
 import time 
 
 
-from sklearn.cluster import KMeans
+from utils.kmeans import get_kmeans
 from tqdm import trange, tqdm
 from utils.loss import SupConLoss
 from backbones.base import freeze_bert_parameters
-from utils.functions import save_model, restore_model, set_torch_seed
+from backbones.SubNets.FeatureNets import cache_frozen_text_states
+from utils.functions import save_model, restore_model, set_torch_seed, save_checkpoint, load_checkpoint
 from transformers import BertTokenizer
 
 from utils.metrics import CLUSTERING_Metrics
@@ -19,7 +20,7 @@ from .pretrain import PretrainUnsupUSNIDManager
 
 from data.utils import get_dataloader
 from data.base import get_data
-from .utils import batch_chunk, get_augment_dataloader, _set_optimizer, view_generator
+from .utils import get_augment_dataloader, _set_optimizer, view_generator
 
 class UnsupUSNIDManager:
     
@@ -80,7 +81,7 @@ class UnsupUSNIDManager:
             
             self.logger.info('Initializing centroids with K-means++...')
             start = time.time()
-            km = KMeans(n_clusters = self.num_labels, random_state=args.seed, init = 'k-means++').fit(feats) 
+            km = get_kmeans(args, self.num_labels, init = 'k-means++').fit(feats) 
             
             km_centroids, assign_labels = km.cluster_centers_, km.labels_
             end = time.time()
@@ -89,7 +90,7 @@ class UnsupUSNIDManager:
         elif init == 'centers':
             
             start = time.time()
-            km = KMeans(n_clusters = self.num_labels, random_state=args.seed, init = self.centroids).fit(feats)
+            km = get_kmeans(args, self.num_labels, init = self.centroids).fit(feats)
             km_centroids, assign_labels = km.cluster_centers_, km.labels_ 
             end = time.time()
             self.logger.info('K-means used %s s', round(end - start, 2))
@@ -103,8 +104,14 @@ class UnsupUSNIDManager:
 
         last_preds = None
         self.model.to(self.device)
+        # The augmented views of training are encoded in full, the cache serves the clustering and the test
+        cache_frozen_text_states(self.model, [self.train_dataloader, self.test_dataloader])
+
+        start_epoch, states = load_checkpoint(args, self.model, self.optimizer, self.scheduler)
+        if states is not None:
+            self.centroids, last_preds, tr_loss = states['centroids'], states['last_preds'], states['tr_loss']
         
-        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):  
+        for epoch in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):  
             
             init_mechanism = 'k-means++' if epoch == 0 else 'centers'
             
@@ -125,9 +132,7 @@ class UnsupUSNIDManager:
                     self.logger.info('Reached tolerance threshold. Stop training.')
                     break                   
             
-            self.train_outputs['label_ids'] = pseudo_labels
-
-            pseudo_train_dataloader = get_augment_dataloader(self.generator, args, self.train_outputs, pseudo_labels)
+            pseudo_train_dataloader = get_augment_dataloader(args, self.train_dataloader.dataset, self.train_outputs, pseudo_labels)
 
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
@@ -142,8 +147,7 @@ class UnsupUSNIDManager:
             
                 with torch.set_grad_enabled(True):
                     
-                    text_feats_a, text_feats_b = batch_chunk(text_feats, dim=2)
-                    label_ids = torch.chunk(input=label_ids, chunks=2, dim=1)[0][:, 0]
+                    text_feats_a, text_feats_b = self.generator.get_views(text_feats)
 
                     aug_mlp_output_a, aug_logits_a = self.model(text_feats_a, video_feats, audio_feats)
                     # loss_model_a = self.model.get_model_loss(args.multimodal_method)
@@ -175,6 +179,8 @@ class UnsupUSNIDManager:
                     self.scheduler.step()
                 
             tr_loss = tr_loss / nb_tr_steps
+
+            save_checkpoint(args, epoch, self.model, self.optimizer, self.scheduler, centroids = self.centroids, last_preds = last_preds, tr_loss = tr_loss)
                 
         if args.save_model:
             save_model(self.model, args.model_output_path)
@@ -186,8 +192,7 @@ class UnsupUSNIDManager:
         feats = outputs['feats']
         y_true = outputs['y_true']
 
-        km = KMeans(n_clusters = self.num_labels, random_state=args.seed, \
-                    init = self.centroids if self.centroids is not None else 'k-means++').fit(feats) 
+        km = get_kmeans(args, self.num_labels, init = self.centroids if self.centroids is not None else 'k-means++').fit(feats) 
        
         y_pred = km.labels_
         
@@ -7,10 +7,13 @@ from tqdm import trange, tqdm
 from backbones.base import freeze_bert_parameters
 from transformers import BertTokenizer
 from utils.loss import SupConLoss
-from utils.functions import save_model, restore_model
-from .utils import batch_chunk, get_augment_dataloader, _set_optimizer, view_generator
+from utils.functions import save_model, restore_model, file_lock, get_pretrain_cache_dir, load_pretrain_cache, save_pretrain_cache
+from .utils import get_augment_dataloader, _set_optimizer, view_generator
 
 
+# The hyper-parameters that are only used after pretraining
+FINETUNE_KEYS = ['lr', 'train_temperature', 'tol', 'freeze_train_bert_parameters', 'eval_batch_size', 'test_batch_size']
+
 class PretrainUnsupUSNIDManager:
     
     def __init__(self, args, data, model):
@@ -25,6 +28,7 @@ class PretrainUnsupUSNIDManager:
         self.optimizer, self.scheduler = _set_optimizer(args, self.model, args.lr_pre)
 
         self.train_outputs = data.train_outputs
+        self.train_data = data.data['train']
         
         self.contrast_criterion = SupConLoss()
 
@@ -32,10 +36,27 @@ class PretrainUnsupUSNIDManager:
         self.generator = view_generator(self.tokenizer, args)
 
         if args.pretrain:
-            
-            self.logger.info('Pre-raining start...')
-            self._train(args)
-            self.logger.info('Pre-training finished...')
+
+            # The grid points that only differ in the fine-tuning hyper-parameters share one pretrained model
+            cache_dir = get_pretrain_cache_dir(args, data.fingerprint, FINETUNE_KEYS)
+            if not os.path.exists(os.path.dirname(cache_dir)):
+                os.makedirs(os.path.dirname(cache_dir), exist_ok = True)
+
+            # Parallel jobs wait for the one pretraining the same model
+            with file_lock(cache_dir + '.lock'):
+                if load_pretrain_cache(cache_dir, self.model):
+                    self.logger.info('Pre-trained model is loaded from %s', cache_dir)
+                else:
+                    self.logger.info('Pre-raining start...')
+                    self._train(args)
+                    self.logger.info('Pre-training finished...')
+                    save_pretrain_cache(cache_dir, self.model)
+
+            if args.save_model:
+                pretrained_model_dir = os.path.join(args.model_output_path, 'pretrain')
+                if not os.path.exists(pretrained_model_dir):
+                    os.makedirs(pretrained_model_dir)
+                save_model(self.model, pretrained_model_dir)
             
         else:
             self.model = restore_model(self.model, os.path.join(args.model_output_path, 'pretrain'), self.device)
@@ -50,7 +71,7 @@ class PretrainUnsupUSNIDManager:
             self.model.train()
             tr_loss, nb_tr_steps = 0, 0
 
-            contrast_dataloader = get_augment_dataloader(self.generator, args, self.train_outputs)
+            contrast_dataloader = get_augment_dataloader(args, self.train_data, self.train_outputs)
 
             for batch in tqdm(contrast_dataloader, desc = "Iteration"):
 
@@ -60,7 +81,7 @@ class PretrainUnsupUSNIDManager:
                 
                 with torch.set_grad_enabled(True):
 
-                    text_feats_a, text_feats_b = batch_chunk(text_feats, dim=2)
+                    text_feats_a, text_feats_b = self.generator.get_views(text_feats)
                     aug_mlp_output_a, _ = self.model(text_feats_a, video_feats, audio_feats)
                     # loss_model_a = self.model.get_model_loss(args.multimodal_method)
                     aug_mlp_output_b, _ = self.model(text_feats_b, video_feats, audio_feats)   
@@ -92,9 +113,3 @@ class PretrainUnsupUSNIDManager:
             self.logger.info("***** Epoch: %s: Eval results *****", str(epoch + 1))
             for key in sorted(eval_results.keys()):
                 self.logger.info("  %s = %s", key, str(eval_results[key]))
-
-        if args.save_model:
-            pretrained_model_dir = os.path.join(args.model_output_path, 'pretrain')
-            if not os.path.exists(pretrained_model_dir):
-                os.makedirs(pretrained_model_dir)
-            save_model(self.model, pretrained_model_dir)
@@ -1,7 +1,8 @@
 import torch
 from torch import optim
 from torch.utils.data import DataLoader, RandomSampler
-from data.mm_pre import MMDataset
+from data.mm_pre import PseudoLabelDataset
+from data.utils import get_collate_fn, build_dataloader, random_token_erase
 import numpy as np
 import torch.nn.functional as F
 from transformers import AdamW, get_linear_schedule_with_warmup
@@ -11,35 +12,20 @@ def batch_chunk(x, dim=1):
     x1, x2 = x1.squeeze(dim), x2.squeeze(dim)
     return x1, x2
 
-def get_augment_dataloader(generator, args, train_outputs, pseudo_labels = None):
-
-    text_data = train_outputs['text']
-    video_data = train_outputs['video']
-    audio_data = train_outputs['audio']
-
-    text_data = torch.tensor(text_data)
-    input_ids, input_mask, segment_ids = text_data[:, 0], text_data[:, 1], text_data[:, 2]
-
+def get_augment_dataloader(args, dataset, train_outputs, pseudo_labels = None):
+    '''
+    The training dataset with the pseudo labels (the labels of train_outputs if None). 
+    The dataset is viewed with the new labels, so the features are not copied. The two token-erased views of each text 
+    are drawn per batch on the device (view_generator.get_views).
+    '''
     if pseudo_labels is None:
         pseudo_labels = train_outputs['label_ids']
-    
-    input_ids_a, input_mask_a = generator.random_token_erase(input_ids, input_mask)
-    input_ids_b, input_mask_b = generator.random_token_erase(input_ids, input_mask)
 
-    train_input_ids = torch.cat(([input_ids_a.unsqueeze(1), input_ids_b.unsqueeze(1)]), dim = 1).tolist()
-    train_input_mask = torch.cat(([input_mask_a.unsqueeze(1), input_mask_b.unsqueeze(1)]), dim = 1).tolist()
-    train_segment_ids = torch.cat(([segment_ids.unsqueeze(1), segment_ids.unsqueeze(1)]), dim = 1).tolist()
-
-    train_text_feats = [[train_input_ids[i], train_input_mask[i], train_segment_ids[i]] for i in range(len(train_input_ids))]
-
-    train_label_ids = torch.tensor(pseudo_labels).unsqueeze(1)
-    train_label_ids = torch.cat(([train_label_ids, train_label_ids]), dim = 1)
+    train_label_ids = torch.as_tensor(np.asarray(pseudo_labels), dtype = torch.long)
     
-    train_data = MMDataset(train_label_ids, train_text_feats, video_data, audio_data)
-
-    sampler = RandomSampler(train_data)
+    train_data = PseudoLabelDataset(dataset, train_label_ids)
 
-    train_dataloader = DataLoader(train_data, sampler = sampler, batch_size = args.train_batch_size)
+    train_dataloader = build_dataloader(train_data, shuffle = True, batch_size = args.train_batch_size, collate_fn = get_collate_fn(args))
 
     return train_dataloader
 
@@ -75,30 +61,23 @@ class view_generator:
     def __init__(self, tokenizer, args):
         self.tokenizer = tokenizer
         self.args = args
+        self.special_ids = torch.tensor(tokenizer.all_special_ids)
     
     def random_token_erase(self, input_ids, input_mask, audio_feats=None, video_feats=None):
-
-        aug_input_ids = []
-        aug_input_mask = []
-        
-        for inp_i, inp_m in zip(input_ids, input_mask):
-            
-            special_tokens_mask = self.tokenizer.get_special_tokens_mask(inp_i, already_has_special_tokens=True)
-            sent_tokens_inds = np.where(np.array(special_tokens_mask) == 0)[0]
-            inds = np.arange(len(sent_tokens_inds))
-            masked_inds = np.random.choice(inds, size = int(len(inds) * self.args.re_prob), replace = False)
-            sent_masked_inds = sent_tokens_inds[masked_inds]
-
-            inp_i = np.delete(inp_i, sent_masked_inds)
-            inp_i = F.pad(inp_i, (0, self.args.text_seq_len - len(inp_i)), 'constant', 0)
-
-            inp_m = np.delete(inp_m, sent_masked_inds)
-            inp_m = F.pad(inp_m, (0, self.args.text_seq_len - len(inp_m)), 'constant', 0)
-    
-            aug_input_ids.append(inp_i)
-            aug_input_mask.append(inp_m)
-        
-        aug_input_ids = torch.stack(aug_input_ids, dim=0)
-        aug_input_mask = torch.stack(aug_input_mask, dim=0)
-
-        return aug_input_ids, aug_input_mask
\ No newline at end of file
+        '''
+        Erases random tokens of all the texts at once (on the device of input_ids).
+        '''
+        return random_token_erase(input_ids, input_mask, self.special_ids, self.args.re_prob, self.args.text_seq_len)
+
+    def get_views(self, text_feats):
+        '''
+        Two token-erased views [batch_size, 3, seq_len] of a batch of texts, erased on the device of text_feats.
+        '''
+        input_ids, input_mask, segment_ids = text_feats[:, 0], text_feats[:, 1], text_feats[:, 2]
+
+        views = []
+        for _ in range(2):
+            aug_input_ids, aug_input_mask = self.random_token_erase(input_ids, input_mask)
+            views.append(torch.stack((aug_input_ids, aug_input_mask, segment_ids), dim = 1))
+
+        return views
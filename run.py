@@ -1,7 +1,10 @@
 from configs.base import ParamManager, add_config_param
 from data.base import DataManager
 from backbones.base import ModelManager
-from utils.functions import set_torch_seed, save_results, set_output_path
+from backbones.SubNets.pretrained import load_pretrained_weights
+from utils.functions import set_torch_seed, save_results, set_output_path, get_job_key, get_finished_jobs, remove_checkpoint
+from utils.results import get_store_path, export_results
+from easydict import EasyDict
 
 import argparse
 import logging
@@ -10,6 +13,9 @@ import datetime
 import itertools
 import warnings
 import random
+import multiprocessing
+import multiprocessing.connection
+import torch
 
 # arguments
 def parse_arguments():
@@ -66,6 +72,10 @@ def parse_arguments():
     
     parser.add_argument('--cache_path', type=str, default='cache', help="The caching directory for pre-trained models.")   
 
+    parser.add_argument('--data_cache_path', type=str, default=None, help="The caching directory for prepared datasets (disabled if not set).")
+
+    parser.add_argument('--shared_data_path', type=str, default=None, help="A shared-memory directory (e.g., /dev/shm) for the prepared datasets, which are mapped by all workers and runs on the host (disabled if not set).")
+
     parser.add_argument('--video_data_path', type=str, default='video_data', help="The directory of the video data.")
 
     parser.add_argument('--audio_data_path', type=str, default='audio_data', help="The directory of the audio data.")
@@ -93,6 +103,32 @@ def parse_arguments():
     parser.add_argument("--ablation_type", type = str, default='full', help="Whether to train the model.")
 
     parser.add_argument('--clustering', action="store_true", help="The method of clustering.")
+
+    parser.add_argument('--dynamic_padding', action="store_true", help="Keep video and audio features unpadded and pad them to the longest sequence in each batch.")
+
+    parser.add_argument('--length_bucketing', action="store_true", help="Group training samples of similar lengths into the same batch.")
+
+    parser.add_argument('--bucket_size', type=int, default=50, help="The number of batches in each length bucket.")
+
+    parser.add_argument('--compact_dataset', action="store_true", help="Store the single-turn datasets as contiguous tensors and fetch each batch with one index operation.")
+
+    parser.add_argument('--num_tokenize_workers', type=int, default=0, help="The number of processes for tokenizing the texts (in the main process if less than 2).")
+
+    parser.add_argument('--frozen_text_cache', action="store_true", help="With frozen backbone parameters, compute the states of the frozen BERT layers once per text and train only the top layers on them (no dropout in the frozen layers).")
+
+    parser.add_argument('--num_jobs', type=int, default=1, help="The number of (hyper-parameters, seed) jobs run in parallel processes.")
+
+    parser.add_argument('--job_threads', type=int, default=0, help="The number of CPU threads of each parallel job (the torch default if 0).")
+
+    parser.add_argument('--resume', action="store_true", help="Save a checkpoint after each epoch, and skip the finished jobs (recorded in the results file) and restart the interrupted ones from their last checkpoint when the grid is run again.")
+
+    parser.add_argument('--feats_dtype', type=str, default='float32', choices=['float32', 'float16'], help="The storage dtype of the video and audio features in memory (cast to float32 per batch).")
+
+    parser.add_argument('--kmeans_engine', type=str, default='sklearn', choices=['sklearn', 'torch'], help="The K-means of the clustering methods: sklearn, or float32 torch on the device of the model (batched distances, warm starts that stop once the centers settle).")
+
+    parser.add_argument('--kmeans_batch_size', type=int, default=0, help="Update the K-means centers on mini-batches of this many samples (full batch if 0).")
+
+    parser.add_argument('--reuse_train_feats', action="store_true", help="Cluster the features captured in the last training pass (UMC, MCN) instead of encoding the training set again, and encode only the samples missing from it.")
     
     args = parser.parse_args()
 
@@ -128,6 +164,9 @@ def set_logger(args):
 def set_up(args):
     
     save_model_name = f"{args.method}_{args.dataset}_{args.text_backbone}_{args.data_mode}_{args.seed}"
+    if args.resume or args.num_jobs > 1:
+        # The checkpoints of a job are found again by its key, and concurrent jobs with the same seed must not share the output directory
+        save_model_name = args.job_key
     
     args.pred_output_path, args.model_output_path = set_output_path(args, save_model_name)
     
@@ -166,9 +205,44 @@ def work(args, data, logger, debug_args=None):
     logger.info('Multimodal intent recognition is finished...')
     if args.save_results:
         
-        logger.info('Results are saved in %s', str(os.path.join(args.results_path, args.results_file_name)))
+        logger.info('Results are saved in %s', get_store_path(args.results_path, args.results_file_name))
         save_results(args, outputs, debug_args=debug_args)
 
+    remove_checkpoint(args)
+
+def run_job(args, data, logger, debug_args, params, seed, job_key):
+
+    args.update(params)
+    args.job_key = job_key
+
+    logger.info("="*30+" Specific Params "+"="*30)
+    for k in args.keys():
+        if k in debug_args.keys():
+            logger.info(f"{k}: {args[k]}") 
+
+    args.seed = seed
+    args = set_up(args)
+    logger.info(f"seed: {seed}") 
+    
+    work(args, data, logger, debug_args)
+
+def run_forked_job(args, data, logger, debug_args, job_id, params, seed, job_key):
+    '''
+    Runs one job in a forked process, which shares the prepared data with the parent process copy-on-write.
+    '''
+    if args.job_threads > 0:
+        torch.set_num_threads(args.job_threads)
+
+    # The jobs are spread over the given GPUs
+    gpu_ids = str(args.gpu_id).split(',')
+    args.gpu_id = gpu_ids[job_id % len(gpu_ids)]
+
+    try:
+        run_job(args, data, logger, debug_args, params, seed, job_key)
+    except Exception:
+        logger.exception(f"Job {job_id} ({params}, seed {seed}) failed.")
+        os._exit(1)
+
 def run(args, data, logger, seeds):
     
     debug_args = {}
@@ -181,21 +255,61 @@ def run(args, data, logger, seeds):
         if k not in debug_args.keys() and k != 'seed':
             logger.info(f"{k}: {args[k]}") 
     
+    # The keys are computed before any job runs, as the methods may add entries to args
+    jobs = []
     for result in itertools.product(*debug_args.values()):
-        for i, key in enumerate(debug_args.keys()):
-            args[key] = result[i]         
-        
-        logger.info("="*30+" Specific Params "+"="*30)
-        for k in args.keys():
-            if k in debug_args.keys():
-                logger.info(f"{k}: {args[k]}") 
-
         for seed in seeds:
-            args.seed = seed
-            args = set_up(args)
-            logger.info(f"seed: {seed}") 
-            
-            work(args, data, logger, debug_args)
+            params = dict(zip(debug_args.keys(), result))
+            jobs.append((params, seed, get_job_key(EasyDict(dict(args, **params, seed = seed)))))
+
+    if args.resume:
+        if not args.save_results:
+            logger.info('The finished jobs are only recorded with --save_results.')
+        finished_jobs = get_finished_jobs(args)
+        num_jobs = len(jobs)
+        jobs = [job for job in jobs if job[2] not in finished_jobs]
+        logger.info(f"{num_jobs - len(jobs)} / {num_jobs} jobs have been finished and are skipped.")
+
+    if args.num_jobs <= 1:
+        for params, seed, job_key in jobs:
+            run_job(args, data, logger, debug_args, params, seed, job_key)
+    else:
+        run_parallel_jobs(args, data, logger, debug_args, jobs)
+
+    if args.save_results:
+        # The CSV file is exported once from the append-only results store
+        csv_path = os.path.join(args.results_path, args.results_file_name)
+        export_results(get_store_path(args.results_path, args.results_file_name), csv_path)
+        logger.info('Results are exported to %s', csv_path)
+
+def run_parallel_jobs(args, data, logger, debug_args, jobs):
+    
+    # The pretrained weights are read once here, and shared by the forked jobs
+    load_pretrained_weights(args.text_pretrained_model)
+
+    # Each job runs in its own (non-daemonic, so that DataLoader workers can be started) forked process, at most num_jobs at a time
+    ctx = multiprocessing.get_context('fork')
+    pending = list(enumerate(jobs))
+    running = {}
+    failed_jobs = []
+
+    while len(pending) > 0 or len(running) > 0:
+
+        while len(pending) > 0 and len(running) < args.num_jobs:
+            job_id, (params, seed, job_key) = pending.pop(0)
+            p = ctx.Process(target = run_forked_job, args = (args, data, logger, debug_args, job_id, params, seed, job_key))
+            p.start()
+            running[p.sentinel] = (p, job_id)
+
+        for sentinel in multiprocessing.connection.wait(list(running.keys())):
+            p, job_id = running.pop(sentinel)
+            p.join()
+            if p.exitcode != 0:
+                failed_jobs.append(job_id)
+
+    logger.info(f"{len(jobs) - len(failed_jobs)} / {len(jobs)} jobs are finished.")
+    if len(failed_jobs) > 0:
+        logger.info(f"Failed jobs: {sorted(failed_jobs)}")
 
 if __name__ == '__main__':
     
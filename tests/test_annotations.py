@@ -0,0 +1,35 @@
+import os
+import tempfile
+import unittest
+from easydict import EasyDict
+
+from data.base import get_indexes_annotations
+from data.text_pre import DatasetProcessor
+
+class TestIndexesAnnotations(unittest.TestCase):
+
+    def test_quoted_texts_match_examples(self):
+
+        args = EasyDict({'dataset': 'MIntRec', 'method': 'mult'})
+        label_map = {'Complain': 0, 'Praise': 1}
+        rows = [
+            ['season', 'episode', 'clip', 'text', 'label'],
+            ['S04', 'E01', '1', '"Oh," she said', 'Complain'],
+            ['S04', 'E01', '2', 'an "unmatched quote', 'Praise'],
+            ['S04', 'E02', '3', 'plain text', 'Complain'],
+        ]
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            with open(os.path.join(data_dir, 'train.tsv'), 'w') as f:
+                f.write('\n'.join('\t'.join(row) for row in rows) + '\n')
+
+            outputs = get_indexes_annotations(args, None, label_map, os.path.join(data_dir, 'train.tsv'))
+            examples = DatasetProcessor(args).get_examples(data_dir, 'train')
+
+        self.assertEqual(outputs['texts'], [example.text_a for example in examples])
+        self.assertEqual(outputs['texts'][0], '"Oh," she said')
+        self.assertEqual(outputs['indexes'], ['S04_E01_1', 'S04_E01_2', 'S04_E02_3'])
+        self.assertEqual(outputs['label_ids'], [0, 1, 0])
+
+if __name__ == '__main__':
+    unittest.main()
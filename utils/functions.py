@@ -1,14 +1,27 @@
 import os
+import uuid
+import fcntl
+import contextlib
 import torch
 import numpy as np
 import pandas as pd
 import random
 import logging
 import copy
+import json
+import hashlib
 from .metrics import Metrics, OOD_Metrics, OID_Metrics, CLUSTERING_Metrics
+from .results import get_store_path, append_results, load_results, save_arrays
 import torch
 import torch.nn.functional as F
 
+CHECKPOINT_FILE = 'checkpoint.pt'
+PRETRAIN_FILE = 'pretrain.pt'
+
+# The options that do not change the results of a job (besides the paths)
+JOB_KEY_EXCLUDED = ['logger_name', 'log_id', 'gpu_id', 'num_workers', 'num_tokenize_workers', 'num_jobs', 'job_threads', 'job_id', 'job_key', 
+                    'resume', 'train', 'tune', 'save_model', 'save_results', 'save_pred', 'model_path', 'results_file_name', 'compact_dataset', 'text_pretrained_model', 'device']
+
 class EarlyStopping:
     """Early stops the training if validation loss doesn't improve after a given patience."""
     def __init__(self, args, delta=1e-6, modality = 'text'):
@@ -47,7 +60,59 @@ class EarlyStopping:
 
             if self.counter >= self.patience:
                 self.early_stop = True
+
+    def state_dict(self):
+
+        return {
+            'counter': self.counter,
+            'best_score': self.best_score,
+            'early_stop': self.early_stop,
+            'best_model': self.best_model.state_dict() if self.best_model is not None else None
+        }
+
+    def load_state_dict(self, state, model):
+        
+        self.counter = state['counter']
+        self.best_score = state['best_score']
+        self.early_stop = state['early_stop']
+
+        if state['best_model'] is not None:
+            self.best_model = copy.deepcopy(model)
+            self.best_model.load_state_dict(state['best_model'])
          
+class FeatureBank:
+    '''
+    The features of the training samples captured in the training pass, which the next clustering reuses instead of encoding 
+    the whole training set again. They are computed with the dropout and the weights of their training step.
+    Only the samples that are not seen in training since the last clustering (the stale ones) need to be encoded again.
+    '''
+    def __init__(self, num_samples):
+
+        self.feats = None
+        self.fresh = torch.zeros(num_samples, dtype = torch.bool)
+
+    def update(self, sample_ids, feats):
+
+        feats = feats.detach().float()
+        if self.feats is None:
+            self.feats = torch.zeros((len(self.fresh), feats.shape[-1]), device = feats.device)
+
+        sample_ids = torch.as_tensor(sample_ids, dtype = torch.long)
+        self.feats[sample_ids.to(self.feats.device)] = feats.to(self.feats.device)
+        self.fresh[sample_ids.cpu()] = True
+
+    def stale_ids(self):
+
+        return torch.nonzero(~self.fresh).squeeze(1).tolist()
+
+    def get_feats(self):
+        '''
+        The features of all the samples, which become stale for the next clustering.
+        '''
+        self.fresh[:] = False
+
+        return self.feats.cpu().numpy()
+
 def set_torch_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -95,13 +160,157 @@ def restore_model(model, model_dir, device):
     model.load_state_dict(m, strict=False)
     return model
 
+def get_job_key(args):
+    '''
+    The deterministic key of a job: the method, the dataset, all the hyper-parameters and the seed in args, 
+    except the options that do not change the results (paths, logging, devices and workers).
+    '''
+    digest = get_args_digest(args, JOB_KEY_EXCLUDED)
+
+    return f"{args.method}_{args.dataset}_{args.text_backbone}_{args.data_mode}_{args.seed}_{digest}"
+
+def get_args_digest(args, excluded, **infos):
+
+    infos.update({k: v for k, v in args.items() if k not in excluded and not k.endswith('_path')})
+
+    return hashlib.md5(json.dumps(infos, sort_keys = True, default = str).encode()).hexdigest()[:10]
+
+@contextlib.contextmanager
+def file_lock(lock_path):
+
+    with open(lock_path, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def get_pretrain_cache_dir(args, fingerprint, finetune_keys):
+    '''
+    The cache directory of a pretrained model in cache_path/pretrain, keyed by the data fingerprint, the seed 
+    and all the hyper-parameters except those only used after pretraining (finetune_keys).
+    '''
+    digest = get_args_digest(args, JOB_KEY_EXCLUDED + list(finetune_keys), data_fingerprint = fingerprint)
+
+    return os.path.join(args.cache_path, 'pretrain', f"{args.method}_{args.dataset}_{args.seed}_{digest}")
+
+def load_pretrain_cache(cache_dir, model):
+    '''
+    Restores a cached pretrained model, and the random states at the end of its pretraining, so that the fine-tuning 
+    runs as if the model had just been pretrained. Returns False if the model has not been cached.
+    '''
+    cache_file = os.path.join(cache_dir, PRETRAIN_FILE)
+    if not os.path.exists(cache_file):
+        return False
+
+    cache = torch.load(cache_file, map_location = 'cpu', weights_only = False)
+    load_model = model.module if hasattr(model, 'module') else model 
+    load_model.load_state_dict(cache['model'])
+    set_rng_state(cache['rng'])
+
+    return True
+
+def save_pretrain_cache(cache_dir, model):
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok = True)
+
+    save_model = model.module if hasattr(model, 'module') else model 
+    cache_file = os.path.join(cache_dir, PRETRAIN_FILE)
+    torch.save({'model': save_model.state_dict(), 'rng': get_rng_state()}, cache_file + '.tmp')
+    os.replace(cache_file + '.tmp', cache_file)
+
+def get_finished_jobs(args):
+    '''
+    The keys of the jobs whose results have been saved.
+    '''
+    df = load_results(get_store_path(args.results_path, args.results_file_name))
+    if 'job_key' not in df.columns:
+        return set()
+
+    return set(df['job_key'].dropna().tolist())
+
+def get_rng_state():
+
+    return {
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    }
+
+def set_rng_state(state):
+
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_checkpoint(args, epoch, model, optimizer = None, scheduler = None, **states):
+    '''
+    Saves the training state at the end of an epoch (with --resume), so that an interrupted job restarts from the next epoch.
+    states holds the other states of the method, e.g., the early stopping or the cluster centroids.
+    '''
+    if not args.get('resume', False):
+        return
+
+    save_model = model.module if hasattr(model, 'module') else model 
+    checkpoint = {
+        'epoch': epoch,
+        'model': save_model.state_dict(),
+        'optimizer': optimizer.state_dict() if optimizer is not None else None,
+        'scheduler': scheduler.state_dict() if scheduler is not None else None,
+        'rng': get_rng_state(),
+        'states': states
+    }
+
+    # The checkpoint is replaced atomically, so that an interruption while saving keeps the previous one
+    checkpoint_path = os.path.join(args.model_output_path, CHECKPOINT_FILE)
+    torch.save(checkpoint, checkpoint_path + '.tmp')
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+def has_checkpoint(args):
+
+    return args.get('resume', False) and os.path.exists(os.path.join(args.model_output_path, CHECKPOINT_FILE))
+
+def load_checkpoint(args, model, optimizer = None, scheduler = None):
+    '''
+    Restores the last checkpoint of the job (with --resume).
+    Returns the epoch to start from and the other states of the method (None if there is no checkpoint).
+    '''
+    if not has_checkpoint(args):
+        return 0, None
+
+    checkpoint_path = os.path.join(args.model_output_path, CHECKPOINT_FILE)
+
+    checkpoint = torch.load(checkpoint_path, map_location = 'cpu', weights_only = False)
+    
+    load_model = model.module if hasattr(model, 'module') else model 
+    load_model.load_state_dict(checkpoint['model'])
+    if optimizer is not None and checkpoint['optimizer'] is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None and checkpoint['scheduler'] is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    set_rng_state(checkpoint['rng'])
+
+    logging.getLogger(args.logger_name).info('Training is resumed from epoch %d of %s', checkpoint['epoch'] + 1, checkpoint_path)
+
+    return checkpoint['epoch'] + 1, checkpoint['states']
+
+def remove_checkpoint(args):
+
+    checkpoint_path = os.path.join(args.model_output_path, CHECKPOINT_FILE)
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
 def save_results(args, test_results, debug_args = None):
     
+    '''
+    Appends the results of the run to the results store, and saves its output arrays under the run id.
+    '''
     save_keys = ['y_pred', 'y_true', 'features', 'scores']
-    for s_k in save_keys:
-        if s_k in test_results.keys():
-            save_path = os.path.join(args.output_path, s_k + '.npy')
-            np.save(save_path, test_results[s_k])
+    run_id = uuid.uuid4().hex
 
     results = {}
     metrics = Metrics(args)
@@ -129,8 +338,8 @@ def save_results(args, test_results, debug_args = None):
         eval_key = 'eval_' + args.eval_monitor
         results.update({eval_key: test_results['best_eval_score']})
 
-    _vars = [args.dataset, args.ood_dataset, args.method, args.text_backbone, args.video_feats, args.audio_feats, args.seed, args.log_id]
-    _names = ['dataset', 'ood_dataset', 'method', 'text_backbone', 'video_feats', 'audio_feats',  'seed', 'log_id']
+    _vars = [args.dataset, args.ood_dataset, args.method, args.text_backbone, args.video_feats, args.audio_feats, args.seed, args.log_id, args.get('job_key')]
+    _names = ['dataset', 'ood_dataset', 'method', 'text_backbone', 'video_feats', 'audio_feats',  'seed', 'log_id', 'job_key']
 
     if debug_args is not None:
         _vars.extend([args[key] for key in debug_args.keys()])
@@ -144,28 +353,17 @@ def save_results(args, test_results, debug_args = None):
         results.pop('video_feats')
         results.pop('audio_feats')
 
-    keys = list(results.keys())
-    values = list(results.values())
-    
-    if not os.path.exists(args.results_path):
-        os.makedirs(args.results_path)
-        
-    results_path = os.path.join(args.results_path, args.results_file_name)
-    
-    if not os.path.exists(results_path) or os.path.getsize(results_path) == 0:
-        ori = []
-        ori.append(values)
-        df1 = pd.DataFrame(ori,columns = keys)
-        df1.to_csv(results_path,index=False)
-    else:
-        df1 = pd.read_csv(results_path)
-        new = pd.DataFrame(results,index=[1])
-        df1 = df1._append(new,ignore_index=True)
-        # df1 = pd.concat([df1,new],axis=0,ignore_index=True)
-        df1.to_csv(results_path,index=False)
-    data_diagram = pd.read_csv(results_path)
+    store_path = get_store_path(args.results_path, args.results_file_name)
+    csv_path = os.path.join(args.results_path, args.results_file_name)
+
+    results['run_id'] = run_id
+    arrays = {s_k: test_results[s_k] for s_k in save_keys if s_k in test_results.keys()}
+    if len(arrays) > 0:
+        save_arrays(store_path, run_id, arrays)
+
+    append_results(store_path, results, csv_path = csv_path)
     
-    print('test_results', data_diagram)
+    print('test_results', results)
 
 
 def softmax_cross_entropy_with_softtarget(input, num_labels, device):
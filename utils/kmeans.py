@@ -0,0 +1,224 @@
+import math
+import torch
+import numpy as np
+from sklearn.cluster import KMeans as SKLearnKMeans, MiniBatchKMeans
+
+__all__ = ['KMeans', 'get_kmeans']
+
+def _pairwise_sq_distances(X, centers, centers_sq_norms = None):
+    '''
+    The squared euclidean distances between the rows of X and the centers, as ||x||^2 - 2 x.c + ||c||^2 (one matrix product).
+    '''
+    if centers_sq_norms is None:
+        centers_sq_norms = (centers * centers).sum(1)
+
+    distances = (X * X).sum(1, keepdim = True) - 2 * X @ centers.t() + centers_sq_norms.unsqueeze(0)
+
+    return distances.clamp_(min = 0)
+
+def _assign(X, centers, chunk_size):
+    '''
+    The closest center of each sample and its squared distance, computed in chunks of samples to bound the memory of the distance matrix.
+    '''
+    centers_sq_norms = (centers * centers).sum(1)
+    labels = torch.empty(len(X), dtype = torch.long, device = X.device)
+    min_distances = torch.empty(len(X), dtype = X.dtype, device = X.device)
+
+    for st in range(0, len(X), chunk_size):
+        distances = _pairwise_sq_distances(X[st: st + chunk_size], centers, centers_sq_norms)
+        min_distances[st: st + chunk_size], labels[st: st + chunk_size] = distances.min(1)
+
+    return labels, min_distances
+
+def _update_centers(X, labels, centers, weights = None):
+    '''
+    The mean of the samples of each cluster. Empty clusters keep their centers.
+    '''
+    n_clusters = len(centers)
+    weights = torch.ones(len(X), dtype = X.dtype, device = X.device) if weights is None else weights
+
+    sums = torch.zeros_like(centers).index_add_(0, labels, X * weights.unsqueeze(1))
+    counts = torch.zeros(n_clusters, dtype = X.dtype, device = X.device).index_add_(0, labels, weights)
+
+    non_empty = counts > 0
+    new_centers = centers.clone()
+    new_centers[non_empty] = sums[non_empty] / counts[non_empty].unsqueeze(1)
+
+    return new_centers, counts
+
+def kmeans_plusplus(X, n_clusters, generator, chunk_size, n_local_trials = None):
+    '''
+    Greedy k-means++ seeding (as sklearn): each new center is the best of n_local_trials candidates sampled in proportion to
+    the squared distances to the chosen centers. The candidates are scored together in one batched distance computation.
+    '''
+    n_samples = len(X)
+    if n_local_trials is None:
+        n_local_trials = 2 + int(math.log(n_clusters))
+
+    centers = torch.empty((n_clusters, X.shape[1]), dtype = X.dtype, device = X.device)
+
+    first = torch.randint(n_samples, (1,), generator = generator, device = generator.device).to(X.device)
+    centers[0] = X[first[0]]
+    _, closest_distances = _assign(X, centers[:1], chunk_size)
+
+    for c in range(1, n_clusters):
+
+        probs = closest_distances if closest_distances.sum() > 0 else torch.ones_like(closest_distances)
+        candidates = torch.multinomial(probs.to(generator.device), n_local_trials, replacement = True, generator = generator).to(X.device)
+
+        # The closest distances if each candidate were added, [n_local_trials, n_samples]
+        candidate_distances = torch.cat([
+            _pairwise_sq_distances(X[st: st + chunk_size], X[candidates]).t() for st in range(0, n_samples, chunk_size)
+        ], dim = 1)
+        candidate_distances = torch.minimum(closest_distances.unsqueeze(0), candidate_distances)
+
+        best = candidate_distances.sum(1).argmin()
+        centers[c] = X[candidates[best]]
+        closest_distances = candidate_distances[best]
+
+    return centers
+
+class KMeans:
+    '''
+    K-means on torch tensors (float32, on the GPU if available), with the interface of sklearn.cluster.KMeans:
+    fit(X) sets cluster_centers_, labels_, inertia_ and n_iter_, and predict(X) assigns new samples.
+
+    init is 'k-means++' or the initial centers. Warm-started from the centers of the previous fit, the Lloyd iterations stop
+    as soon as the centers move less than tol (relative to the mean variance of the features, as sklearn),
+    so a small change of the features takes only a few iterations.
+    With batch_size > 0, the centers are updated on mini-batches of samples (Sculley, 2010) instead of the full data in each iteration.
+    '''
+    def __init__(self, n_clusters, init = 'k-means++', n_init = 1, max_iter = 300, tol = 1e-4, batch_size = 0,
+                 random_state = None, device = None, chunk_size = 65536):
+
+        self.n_clusters = n_clusters
+        self.init = init
+        self.n_init = n_init
+        self.max_iter = max_iter
+        self.tol = tol
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.device = device
+        self.chunk_size = chunk_size
+
+    def _to_tensor(self, X):
+
+        X = torch.as_tensor(X)
+        device = X.device if self.device is None else self.device
+
+        return X.to(device = device, dtype = torch.float32)
+
+    def _get_generator(self, device):
+
+        generator = torch.Generator(device = device)
+        if self.random_state is None:
+            generator.seed()
+        else:
+            generator.manual_seed(int(self.random_state))
+
+        return generator
+
+    def _lloyd(self, X, centers, tol):
+
+        n_iter = 0
+        labels = None
+
+        for n_iter in range(1, self.max_iter + 1):
+
+            new_labels, _ = _assign(X, centers, self.chunk_size)
+            new_centers, _ = _update_centers(X, new_labels, centers)
+
+            center_shift = ((new_centers - centers) ** 2).sum()
+            converged = labels is not None and torch.equal(new_labels, labels)
+            centers, labels = new_centers, new_labels
+
+            if converged or center_shift <= tol:
+                break
+
+        return centers, n_iter
+
+    def _mini_batch(self, X, centers, tol, generator):
+
+        counts = torch.zeros(self.n_clusters, dtype = X.dtype, device = X.device)
+        n_iter = 0
+
+        for n_iter in range(1, self.max_iter + 1):
+
+            old_centers = centers
+            perm = torch.randperm(len(X), generator = generator, device = generator.device).to(X.device)
+
+            for st in range(0, len(X), self.batch_size):
+                batch = X[perm[st: st + self.batch_size]]
+                labels, _ = _assign(batch, centers, self.chunk_size)
+                batch_centers, batch_counts = _update_centers(batch, labels, centers)
+
+                # Each center moves towards the mean of its batch samples, with a learning rate of 1 / (its number of samples so far)
+                counts = counts + batch_counts
+                rates = (batch_counts / counts.clamp(min = 1)).unsqueeze(1)
+                centers = centers + rates * (batch_centers - centers)
+
+            if ((centers - old_centers) ** 2).sum() <= tol:
+                break
+
+        return centers, n_iter
+
+    def fit(self, X):
+
+        X = self._to_tensor(X)
+        generator = self._get_generator(X.device)
+
+        tol = self.tol * X.var(0).mean()
+        warm_start = not (isinstance(self.init, str) and self.init == 'k-means++')
+        n_init = 1 if warm_start else self.n_init
+
+        best_inertia = None
+        for _ in range(n_init):
+
+            if warm_start:
+                centers = self._to_tensor(self.init).to(X.device).clone()
+            else:
+                centers = kmeans_plusplus(X, self.n_clusters, generator, self.chunk_size)
+
+            if self.batch_size > 0:
+                centers, n_iter = self._mini_batch(X, centers, tol, generator)
+            else:
+                centers, n_iter = self._lloyd(X, centers, tol)
+
+            labels, min_distances = _assign(X, centers, self.chunk_size)
+            inertia = min_distances.sum().item()
+
+            if best_inertia is None or inertia < best_inertia:
+                best_inertia = inertia
+                best_centers, best_labels, best_n_iter = centers, labels, n_iter
+
+        self.cluster_centers_ = best_centers.cpu().numpy()
+        self.labels_ = best_labels.cpu().numpy()
+        self.inertia_ = best_inertia
+        self.n_iter_ = best_n_iter
+
+        return self
+
+    def predict(self, X):
+
+        X = self._to_tensor(X)
+        centers = torch.as_tensor(self.cluster_centers_, device = X.device)
+        labels, _ = _assign(X, centers, self.chunk_size)
+
+        return labels.cpu().numpy()
+
+def get_kmeans(args, n_clusters, init = 'k-means++'):
+    '''
+    The K-means of the clustering methods: sklearn (the default), or the torch engine (--kmeans_engine torch) on the device of the model.
+    Both are updated on mini-batches of --kmeans_batch_size samples if it is set (full batch if 0).
+    '''
+    if isinstance(init, torch.Tensor):
+        init = init.cpu().numpy()
+
+    if args.kmeans_engine == 'torch':
+        return KMeans(n_clusters = n_clusters, init = init, batch_size = args.kmeans_batch_size,
+                      random_state = args.seed, device = args.device)
+
+    if args.kmeans_batch_size > 0:
+        return MiniBatchKMeans(n_clusters = n_clusters, random_state = args.seed, init = init, batch_size = args.kmeans_batch_size)
+
+    return SKLearnKMeans(n_clusters = n_clusters, random_state = args.seed, init = init)
@@ -1,90 +1,64 @@
 import torch
-import torch.nn.functional as F
 
 def generate_context(args, feats, qmask, umask, lengths, context_len = 1, modality = 'text'):
-    
-    bs = feats.shape[0]
-    dia_len = feats.shape[1]
- 
-    tensor_shape = feats.shape
-    tensor_shape = list(tensor_shape)
+    '''
+    Appends the history of the same speaker to each utterance of the dialogues, most recent first:
+        text: [CLS] utterance [SEP] + history utterances without [CLS] (segment ids 1)
+        video / audio: utterance frames + a zero frame + history frames
+    The results are truncated or zero-padded to (context_len + 1) times the input sequence length.
+
+    The positions of all utterances are computed at once, and the features are gathered in one indexing operation on the device.
+    '''
+    bs, dia_len = feats.shape[0], feats.shape[1]
+
+    if modality == 'text':
+        # [bs, dia_len, 3, seq_len] -> [bs, dia_len, seq_len, 3]
+        feats = feats.transpose(-1, -2)
+
+    seq_len = feats.shape[-2]
+    max_seq_len = round((context_len + 1) * seq_len)
+
+    lengths = lengths.view(bs, dia_len).long().to(feats.device)
+    qmask = qmask.view(bs, dia_len).to(feats.device)
+    valid = lengths > 0
+
+    # history[b, j, k]: utterance k is a history utterance of utterance j
+    pos = torch.arange(dia_len, device = feats.device)
+    history = (qmask.unsqueeze(2) == qmask.unsqueeze(1)) & (pos.view(1, 1, -1) < pos.view(1, -1, 1)) \
+              & valid.unsqueeze(1) & valid.unsqueeze(2)
+
+    # The [CLS] of the history utterances is dropped in text, and a zero frame separates the history in video / audio
+    offset = 1 if modality == 'text' else 0
+    seg_lengths = (lengths - offset).clamp(min = 0).unsqueeze(1) * history
+    seg_lengths = seg_lengths.flip(-1)
+    seg_ends = seg_lengths.cumsum(-1)
+
+    has_history = history.any(-1, keepdim = True)
+    history_st = lengths.unsqueeze(-1) + (0 if modality == 'text' else has_history.long())
+
+    out_pos = torch.arange(max_seq_len, device = feats.device).view(1, 1, -1)
+    is_cur = out_pos < lengths.unsqueeze(-1)
+
+    # Locate the history utterance (in the most-recent-first order) of each output position
+    q = (out_pos - history_st).clamp(min = 0).expand(bs, dia_len, max_seq_len).contiguous()
+    seg_idx = torch.searchsorted(seg_ends.view(bs * dia_len, -1), q.view(bs * dia_len, -1), right = True).view(bs, dia_len, max_seq_len)
+    is_history = (out_pos >= history_st) & (seg_idx < dia_len) & ~is_cur
+    seg_idx = seg_idx.clamp(max = dia_len - 1)
+
+    seg_st = (seg_ends - seg_lengths).gather(-1, seg_idx)
+    src_utt = torch.where(is_cur, pos.view(1, -1, 1), dia_len - 1 - seg_idx)
+    src_pos = torch.where(is_cur, out_pos, q - seg_st + offset)
+
+    is_valid = (is_cur | is_history) & valid.unsqueeze(-1)
+    src_idx = (src_utt * seq_len + src_pos.clamp(max = seq_len - 1)) * is_valid
+
+    flat_feats = feats.reshape(bs, dia_len * seq_len, feats.shape[-1])
+    results = flat_feats.gather(1, src_idx.view(bs, -1, 1).expand(-1, -1, feats.shape[-1]))
+    results = results.view(bs, dia_len, max_seq_len, feats.shape[-1]) * is_valid.unsqueeze(-1).to(feats.dtype)
+
+    if modality == 'text':
+        # The segment ids of the history tokens are 1
+        results[..., 2] = torch.where(is_history & is_valid, torch.ones_like(results[..., 2]), results[..., 2])
+        results = results.transpose(-1, -2).contiguous()
 
-    if modality == 'text':    
-        max_seq_len = tensor_shape[-1] = round((context_len + 1) * tensor_shape[-1])
-    else:
-        max_seq_len = tensor_shape[-2] = round((context_len + 1) * tensor_shape[-2])
-        max_feat_dim = tensor_shape[-1]
- 
-    tensor_shape = tuple(tensor_shape)
-    results = torch.zeros(tensor_shape, dtype=feats.dtype, device=feats.device)
-
-    for i, (fe, qm, le) in enumerate(zip(feats, qmask, lengths)):
- 
-        q0 = {}
-
-        for j, (fe_batch, qm_batch, le_batch) in enumerate(zip(fe, qm, le)):
-            
-            qm_batch = int(qm_batch.cpu().numpy())
- 
-            if le_batch == 0:
-                results[i][j] = torch.zeros((tensor_shape[-2], tensor_shape[-1]))
-                continue
-
-            if qm_batch in q0.keys():
-
-                history_fe = q0[qm_batch]
-
-                if modality == 'text':
-                    
-                    history_length = torch.sum(history_fe[1])
-                                                                                                                                                                                                                                                                                                   
-                    history_fe[2][: history_length] = 1
-                    q_feat = updated_feat = torch.cat((fe_batch[:, :le_batch], history_fe[:, 1:]), dim = -1)
-
-                else:
-                    cur_feature_identifier = torch.zeros((1, max_feat_dim)).to(fe_batch.device)
-
-                    cur_feats = torch.cat([fe_batch[:le_batch, :], cur_feature_identifier], dim = -2)
-                  
-                    q_feat = torch.cat((fe_batch[:le_batch, :], history_fe), dim = -2)
-
-                    updated_feat = torch.cat((cur_feats, history_fe), dim = -2)
-
-            else:
-                updated_feat = q_feat = fe_batch[:le_batch]
-
- 
-            q0[qm_batch] = q_feat
-            cur_feat = updated_feat
- 
-            if modality == 'text':
-                cur_len = cur_feat.shape[-1]
-
-                if cur_len >= max_seq_len:
-                    cur_feat = cur_feat[:, :max_seq_len]
-                    final_feat = cur_feat
-                else:
-                    pad_length = max_seq_len - cur_len
-                    padding = (0, pad_length)
-                    final_feat = F.pad(cur_feat, padding, mode='constant', value=0)
-
-            else:
-                cur_len = cur_feat.shape[-2]
-
-                if cur_len >= max_seq_len:
-                    cur_feat = cur_feat[:max_seq_len, :]
-                    final_feat = cur_feat
-                else:
-                    pad_length = max_seq_len - cur_len
-                    padding = (0, 0, 0, pad_length)
-                    final_feat = F.pad(cur_feat, padding, mode='constant', value=0)
-
-            results[i][j] = final_feat
- 
     return results
-    
-
-
-
-
-
@@ -0,0 +1,142 @@
+import os
+import json
+import fcntl
+import argparse
+import numpy as np
+import pandas as pd
+
+__all__ = ['get_store_path', 'append_results', 'load_results', 'query_results', 'export_results', 'save_arrays', 'load_arrays']
+
+def get_store_path(results_path, results_file_name):
+    '''
+    The results of 'results_path/results.csv' are stored in 'results_path/results.jsonl', one JSON line per run.
+    The CSV file is exported from the store (see export_results).
+    '''
+    return os.path.join(results_path, os.path.splitext(results_file_name)[0] + '.jsonl')
+
+def get_arrays_path(store_path):
+
+    return os.path.splitext(store_path)[0] + '_arrays'
+
+def _to_json(obj):
+
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    return str(obj)
+
+def _import_csv(store_path, csv_path):
+    '''
+    Moves the rows of a legacy results CSV file into a new store, so that exporting the store does not drop them.
+    '''
+    if os.path.exists(store_path) or not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
+        return
+
+    df = pd.read_csv(csv_path)
+    with open(store_path, 'w') as f:
+        for row in df.to_dict(orient = 'records'):
+            row = {k: v for k, v in row.items() if not (isinstance(v, float) and np.isnan(v))}
+            f.write(json.dumps(row, default = _to_json) + '\n')
+
+def append_results(store_path, results, csv_path = None):
+    '''
+    Appends the results of one run as one line of the store. The append is locked, so that parallel runs never interleave their lines,
+    and its cost does not depend on the number of stored runs.
+    '''
+    store_dir = os.path.dirname(store_path)
+    if store_dir and not os.path.exists(store_dir):
+        os.makedirs(store_dir, exist_ok = True)
+
+    line = json.dumps(results, default = _to_json) + '\n'
+
+    with open(store_path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+        if csv_path is not None:
+            _import_csv(store_path, csv_path)
+
+        with open(store_path, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def load_results(store_path):
+
+    if not os.path.exists(store_path):
+        return pd.DataFrame()
+
+    rows = []
+    with open(store_path, 'r') as f:
+        for line in f:
+            # A run killed while writing leaves a truncated last line
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+
+    return pd.DataFrame(rows)
+
+def query_results(store_path, **conditions):
+    '''
+    The stored runs matching all the conditions, e.g., query_results(store_path, method = 'umc', seed = 0).
+    '''
+    df = load_results(store_path)
+
+    for k, v in conditions.items():
+        if k not in df.columns:
+            return df.iloc[0:0]
+        df = df[df[k] == v]
+
+    return df
+
+def export_results(store_path, csv_path, **conditions):
+    '''
+    Writes the stored runs matching the conditions into a CSV file. A legacy CSV file without a store is left as it is.
+    '''
+    if not os.path.exists(store_path):
+        return pd.DataFrame()
+
+    df = query_results(store_path, **conditions)
+    df.to_csv(csv_path + '.tmp', index = False)
+    os.replace(csv_path + '.tmp', csv_path)
+
+    return df
+
+def save_arrays(store_path, run_id, arrays):
+    '''
+    Saves the output arrays (e.g., y_pred, y_true and features) of a run in 'results_arrays/run_id.npz'.
+    '''
+    arrays_path = get_arrays_path(store_path)
+    if not os.path.exists(arrays_path):
+        os.makedirs(arrays_path, exist_ok = True)
+
+    np.savez(os.path.join(arrays_path, run_id + '.npz'), **arrays)
+
+def load_arrays(store_path, run_id):
+
+    arrays = np.load(os.path.join(get_arrays_path(store_path), run_id + '.npz'))
+
+    return {k: arrays[k] for k in arrays.files}
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = 'Export the stored results into a CSV file.')
+    parser.add_argument('--results_path', type=str, default='results', help="The path of the results.")
+    parser.add_argument('--results_file_name', type=str, default='results.csv', help="The CSV file name of the results.")
+    parser.add_argument('--where', type=str, nargs='*', default=[], help="Conditions of the exported runs, e.g., method=umc seed=0.")
+    parser.add_argument('--export_file_name', type=str, default=None, help="The exported CSV file name (results_file_name if not set).")
+    args = parser.parse_args()
+
+    conditions = {}
+    for cond in args.where:
+        k, v = cond.split('=', 1)
+        try:
+            conditions[k] = json.loads(v)
+        except json.JSONDecodeError:
+            conditions[k] = v
+
+    csv_path = os.path.join(args.results_path, args.export_file_name or args.results_file_name)
+    df = export_results(get_store_path(args.results_path, args.results_file_name), csv_path, **conditions)
+    print('%d runs are exported to %s' % (len(df), csv_path))